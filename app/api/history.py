@@ -3,41 +3,126 @@ History data module using PySpark for processing JSONL journey data.
 
 Provides functions to query historical delay data for the dashboard.
 Uses Spark for efficient data processing even with local mode.
+
+Spark does its work once per data snapshot, not per request: the JSONL
+files are flattened into a cached (and Parquet-persisted) segment table,
+and the parameterless dashboard aggregates are computed at load time and
+served from driver memory. Only parameterized queries still run Spark
+jobs, and their results are memoized per data signature.
 """
 
+import os
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import (
-    explode, col, avg, max as spark_max, min as spark_min,
+    inline, col, avg, max as spark_max, min as spark_min,
     count, sum as spark_sum, when, floor, from_unixtime,
-    hour, dayofweek, collect_list, first, struct, array_agg,
-    row_number, desc, collect_set, concat_ws
+    hour, dayofweek, first, row_number, desc, collect_list,
+    timestamp_seconds, lit, coalesce, grouping_id,
+    round as spark_round, array_sort, max_by, struct
 )
 from pyspark.sql.window import Window
 from pyspark.sql.types import (
     StructType, StructField, StringType, IntegerType,
-    LongType, BooleanType, ArrayType
+    LongType, ArrayType, IntegralType
 )
 from pathlib import Path
-from datetime import datetime
 from typing import Dict, List, Optional, Any
 
+from ..spark.delay_pipeline import PARQUET_CACHE_DIR, sync_parquet_snapshots
+
 logger = logging.getLogger(__name__)
 
+RESULT_CACHE_SIZE = 128
+# Pages ending within this many rows are served by a top-K sort; deeper
+# pages fall back to a row_number window instead of collecting every
+# skipped row on the driver
+TOP_K_MAX_ROWS = 10_000
+DELAY_THRESHOLD_MINUTES = 2
+
+EMPTY_DELAY_STATS = {
+    "delay_minutes": 0,
+    "max_delay_minutes": 0,
+    "min_delay_minutes": 0,
+    "delayed_percentage": 0,
+    "total_journeys": 0,
+    "total_segments": 0
+}
+
+DAY_NAMES = {
+    1: "Sonntag",
+    2: "Montag",
+    3: "Dienstag",
+    4: "Mittwoch",
+    5: "Donnerstag",
+    6: "Freitag",
+    7: "Samstag"
+}
+
 _spark: Optional[SparkSession] = None
 
 
+def cache_storage_level(spark: SparkSession) -> StorageLevel:
+    """
+    Storage level for the cached tables.
+
+    OFF_HEAP when the session has off-heap memory configured, so the cache
+    does not compete with query execution for the driver heap; otherwise
+    MEMORY_AND_DISK, which spills to local disk instead of silently
+    recomputing when the cache outgrows the heap.
+    """
+    if spark.conf.get("spark.memory.offHeap.enabled", "false") == "true":
+        return StorageLevel.OFF_HEAP
+    return StorageLevel.MEMORY_AND_DISK
+
+
 def get_spark_session() -> SparkSession:
-    """Get or create SparkSession for the API."""
+    """
+    Get or create SparkSession for the API.
+
+    The dashboard runs Spark in local mode on a single host, so the session
+    is sized for that: one shuffle partition per core instead of the cluster
+    default of 200, which otherwise turns every small groupBy into hundreds
+    of near-empty tasks. Adaptive execution coalesces what is still too
+    small at runtime, and the small per-segment and per-journey frames
+    are joined by broadcast.
+
+    Setting SPARK_OFFHEAP_SIZE (e.g. "512m") moves the table cache into
+    off-heap memory outside the driver heap; see cache_storage_level.
+    """
     global _spark
     if _spark is None:
-        _spark = SparkSession.builder \
+        cores = str(os.cpu_count() or 4)
+        offheap_size = os.getenv("SPARK_OFFHEAP_SIZE", "")
+        builder = SparkSession.builder \
             .appName("DBPrangerDashboard") \
-            .config("spark.driver.memory", "1g") \
+            .config("spark.driver.memory", os.getenv("SPARK_DRIVER_MEMORY", "1g")) \
             .config("spark.sql.legacy.timeParserPolicy", "LEGACY") \
             .config("spark.ui.enabled", "false") \
-            .master("local[*]") \
-            .getOrCreate()
+            .config("spark.sql.shuffle.partitions", cores) \
+            .config("spark.default.parallelism", cores) \
+            .config("spark.sql.adaptive.enabled", "true") \
+            .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+            .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "16m") \
+            .config("spark.sql.autoBroadcastJoinThreshold", "32m") \
+            .config("spark.sql.inMemoryColumnarStorage.compressed", "true") \
+            .config("spark.sql.inMemoryColumnarStorage.batchSize", "20000") \
+            .config("spark.sql.inMemoryColumnarStorage.partitionPruning", "true") \
+            .config("spark.sql.json.filterPushdown.enabled", "true") \
+            .config("spark.sql.execution.arrow.pyspark.enabled", "true") \
+            .config("spark.sql.execution.arrow.maxRecordsPerBatch", "10000") \
+            .config("spark.hadoop.io.file.buffer.size", str(1024 * 1024)) \
+            .master("local[*]")
+        if offheap_size:
+            builder = builder \
+                .config("spark.memory.offHeap.enabled", "true") \
+                .config("spark.memory.offHeap.size", offheap_size)
+        _spark = builder.getOrCreate()
         
         _spark.sparkContext.setLogLevel("WARN")
         logger.info("Spark session created for Dashboard API")
@@ -46,50 +131,98 @@ def get_spark_session() -> SparkSession:
 
 
 def get_transport_schema():
-    """Define schema for transport JSONL data."""
+    """
+    Define schema for transport JSONL data.
+    
+    Only the fields the dashboard reads are declared; the JSON reader skips
+    everything else (stop point keys, destination, isFirst/isLast, ...)
+    instead of parsing it and copying it through the explode.
+    """
     segment_schema = StructType([
-        StructField("startStopPointKey", StringType(), True),
-        StructField("endStopPointKey", StringType(), True),
         StructField("startStationName", StringType(), True),
         StructField("startStationKey", StringType(), True),
         StructField("startDateTime", LongType(), True),
         StructField("endStationName", StringType(), True),
         StructField("endStationKey", StringType(), True),
-        StructField("endDateTime", LongType(), True),
-        StructField("destination", StringType(), True),
-        StructField("realtimeDelay", IntegerType(), True),
-        StructField("isFirst", BooleanType(), True),
-        StructField("isLast", BooleanType(), True)
+        StructField("realtimeDelay", IntegerType(), True)
     ])
     
     line_type_schema = StructType([
-        StructField("simpleType", StringType(), True),
-        StructField("model", StringType(), True)
+        StructField("simpleType", StringType(), True)
     ])
     
     line_schema = StructType([
         StructField("name", StringType(), True),
         StructField("direction", StringType(), True),
-        StructField("origin", StringType(), True),
-        StructField("type", line_type_schema, True),
-        StructField("id", StringType(), True)
+        StructField("type", line_type_schema, True)
     ])
     
     journey_schema = StructType([
         StructField("journeyID", StringType(), True),
         StructField("line", line_schema, True),
         StructField("vehicleType", StringType(), True),
-        StructField("realtime", BooleanType(), True),
         StructField("segments", ArrayType(segment_schema), True)
     ])
     
     return StructType([
         StructField("ingestion_iso", StringType(), True),
-        StructField("box_index", IntegerType(), True),
         StructField("journeys", ArrayType(journey_schema), True)
     ])
 
 
+def delay_status(delay):
+    """Spark expression bucketing a delay column into good/warning/critical."""
+    return when(delay < 2, lit("good")) \
+        .when(delay < 5, lit("warning")) \
+        .otherwise(lit("critical"))
+
+
+def collect_records(df) -> List[Dict[str, Any]]:
+    """
+    Collect a result DataFrame to the driver as a list of dicts.
+    
+    Goes through toPandas() so columns are transferred in Arrow batches
+    instead of one Py4J-marshalled Row at a time. Nulls come back as None
+    (not NaN) so the records stay JSON-serializable, and integer columns,
+    which pandas widens to float64 when they contain nulls, come back as
+    ints like Row.asDict() returns them.
+    """
+    pdf = df.toPandas()
+    for field in df.schema.fields:
+        if isinstance(field.dataType, IntegralType):
+            pdf[field.name] = pdf[field.name].astype("Int64")
+    return pdf.astype(object).where(pdf.notna(), None).to_dict(orient="records")
+
+
+def cached_result(method):
+    """
+    Memoize a query method's JSON-ready result in an in-process LRU.
+    
+    Entries are keyed by method name, arguments and the data signature of
+    the loaded snapshot, so repeated dashboard polls skip Spark entirely.
+    The data is loaded once per process (in __init__), so the signature is
+    fixed for the process lifetime; new JSONL files are picked up on the
+    next restart.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, frozenset(kwargs.items()), self._data_signature)
+        with self._result_lock:
+            if key in self._result_cache:
+                self._result_cache.move_to_end(key)
+                return self._result_cache[key]
+        
+        result = method(self, *args, **kwargs)
+        
+        with self._result_lock:
+            self._result_cache[key] = result
+            if len(self._result_cache) > RESULT_CACHE_SIZE:
+                self._result_cache.popitem(last=False)
+        return result
+    
+    return wrapper
+
+
 class SparkHistoryManager:
     """
     Manages historical journey data using PySpark.
@@ -97,78 +230,205 @@ class SparkHistoryManager:
     Uses Spark for efficient querying and aggregation.
     """
     
-    def __init__(self, data_dir: Optional[str] = None):
+    def __init__(self, data_dir: Optional[str] = None, cache_dir: Optional[str] = None):
         """Initialize with data directory path."""
         if data_dir is None:
             self.data_dir = Path("/db_pranger/data")
         else:
             self.data_dir = Path(data_dir)
         
+        if cache_dir is None:
+            self.cache_dir = PARQUET_CACHE_DIR
+        else:
+            self.cache_dir = Path(cache_dir)
+        
         logger.info("Loading data from: %s", self.data_dir)
         
-        self.spark = get_spark_session()
-        self._df = None
-        self._cached_count: Optional[int] = None
+        # Created on the first load that actually has files to read
+        self.spark: Optional[SparkSession] = None
+        self._data_signature = ""
+        self._result_cache: OrderedDict = OrderedDict()
+        self._result_lock = threading.Lock()
+        # Held while counting a filter's total, so concurrent first
+        # requests for the same filter run one count job, not one each
+        self._totals_lock = threading.Lock()
         self._load_data()
     
+    def _reset_state(self):
+        """Reset the loaded table and everything derived from it to empty."""
+        for cached_df in (getattr(self, "_df", None), getattr(self, "_final_df", None)):
+            if cached_df is not None:
+                cached_df.unpersist()
+        self._df = None
+        self._final_df = None
+        self._total_segments = 0
+        self._total_journeys = 0
+        self._is_empty = True
+        self._filtered_totals: Dict[tuple, int] = {}
+        self._by_journey: Dict[str, List[Dict[str, Any]]] = {}
+        self._delay_stats: Dict[str, Any] = dict(EMPTY_DELAY_STATS)
+        self._stats_by_line: List[Dict[str, Any]] = []
+        self._heatmap: List[Dict[str, Any]] = []
+        self._unique_lines: List[Dict[str, str]] = []
+    
+    @property
+    def data_signature(self) -> str:
+        """Fingerprint of the JSONL input behind the currently loaded data."""
+        return self._data_signature
+    
+    def _compute_data_signature(self) -> str:
+        """
+        Fingerprint the JSONL input by file name, size and mtime.
+        
+        Changes whenever the collector appends to a file or a new day's
+        file appears, so the Parquet cache is rebuilt only when needed.
+        """
+        digest = hashlib.sha1()
+        for path in sorted(self.data_dir.glob("*.jsonl")):
+            stat = path.stat()
+            digest.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+        return digest.hexdigest()[:16]
+    
+    def _read_jsonl(self, jsonl_pattern: str):
+        """Parse and flatten raw JSONL files into one row per segment."""
+        schema = get_transport_schema()
+        # One record per line: keep the line-splitting fast path and drop a
+        # half-written trailing line from the collector instead of
+        # materializing it as an all-null row
+        raw_df = self.spark.read \
+            .schema(schema) \
+            .option("multiLine", "false") \
+            .option("lineSep", "\n") \
+            .option("mode", "DROPMALFORMED") \
+            .json(jsonl_pattern)
+        
+        # Flatten: inline() unpacks each journey/segment struct straight into
+        # columns, so no intermediate struct column is copied per row
+        return raw_df \
+            .select(
+                col("ingestion_iso"),
+                inline("journeys")
+            ) \
+            .select(
+                col("ingestion_iso"),
+                col("journeyID").alias("journey_id"),
+                col("line.name").alias("line"),
+                col("line.direction").alias("direction"),
+                col("line.type.simpleType").alias("line_type"),
+                col("vehicleType").alias("vehicle_type"),
+                inline("segments")
+            ) \
+            .select(
+                col("ingestion_iso"),
+                col("journey_id"),
+                col("line"),
+                col("direction"),
+                col("line_type"),
+                col("vehicle_type"),
+                col("startStationName").alias("start_station"),
+                col("startStationKey").alias("start_station_key"),
+                col("endStationName").alias("end_station"),
+                col("endStationKey").alias("end_station_key"),
+                col("startDateTime").alias("start_timestamp"),
+                col("realtimeDelay").alias("delay_minutes")
+            )
+    
     def _load_data(self):
-        """Load all JSONL files using Spark."""
-        jsonl_pattern = str(self.data_dir / "*.jsonl")
+        """
+        Load the flattened segment table.
+        
+        Each JSONL file is flattened with Spark once and written to a
+        Parquet snapshot in the cache directory; later starts read the
+        snapshots instead of re-parsing the JSON.
+        """
+        self._data_signature = self._compute_data_signature()
+        with self._result_lock:
+            self._result_cache.clear()
+        self._reset_state()
+        
+        jsonl_files = sorted(self.data_dir.glob("*.jsonl"))
+        if not jsonl_files:
+            # Nothing to aggregate: don't pay for a JVM start just to fail
+            # reading an empty glob
+            logger.warning("No JSONL files found in %s; serving empty history", self.data_dir)
+            return
+        
+        if self.spark is None:
+            self.spark = get_spark_session()
         
         try:
-            schema = get_transport_schema()
-            raw_df = self.spark.read.schema(schema).json(jsonl_pattern)
+            try:
+                snapshots = sync_parquet_snapshots(
+                    jsonl_files, self.cache_dir, "segments", self._read_jsonl,
+                    prune_unlisted=True
+                )
+                df = self.spark.read.parquet(*snapshots)
+            except Exception as e:
+                logger.warning("Parquet cache unavailable, reading JSONL directly: %s", e)
+                df = self._read_jsonl(str(self.data_dir / "*.jsonl"))
             
-            # Flatten: explode journeys, then segments
-            self._df = raw_df \
-                .select(
-                    col("ingestion_iso"),
-                    explode("journeys").alias("journey")
-                ) \
-                .select(
-                    col("ingestion_iso"),
-                    col("journey.journeyID").alias("journey_id"),
-                    col("journey.line.name").alias("line"),
-                    col("journey.line.direction").alias("direction"),
-                    col("journey.line.type.simpleType").alias("line_type"),
-                    col("journey.vehicleType").alias("vehicle_type"),
-                    explode("journey.segments").alias("segment")
-                ) \
-                .select(
-                    col("ingestion_iso"),
-                    col("journey_id"),
-                    col("line"),
-                    col("direction"),
-                    col("line_type"),
-                    col("vehicle_type"),
-                    col("segment.startStationName").alias("start_station"),
-                    col("segment.startStationKey").alias("start_station_key"),
-                    col("segment.endStationName").alias("end_station"),
-                    col("segment.endStationKey").alias("end_station_key"),
-                    col("segment.startDateTime").alias("start_timestamp"),
-                    col("segment.realtimeDelay").alias("delay_minutes")
+            storage_level = cache_storage_level(self.spark)
+            # Co-locate each line's rows so per-line groupBys work on
+            # clustered partitions, and sort them so every cached batch
+            # covers a narrow line/vehicle_type range: the in-memory scan
+            # skips batches whose min/max stats exclude a line filter.
+            # is_delayed is a 1-byte flag so every "delayed" aggregate is
+            # a plain columnar sum instead of a per-row branch.
+            self._df = df \
+                .withColumn(
+                    "is_delayed",
+                    when(col("delay_minutes") > DELAY_THRESHOLD_MINUTES, 1).otherwise(0).cast("byte")
                 ) \
-                .cache()  # Cache for repeated queries
+                .repartition(col("line")) \
+                .sortWithinPartitions("line", "vehicle_type") \
+                .persist(storage_level)
             
-            self._cached_count = self._df.count()
-            logger.info("Loaded %d segment records via Spark", self._cached_count)
+            # Building the journey index collects every segment, which
+            # materializes the cache and yields the segment total without a
+            # separate count job. Journeys are counted by the final-delay
+            # rollup below, which already has one row per journey.
+            self._by_journey = self._build_journey_index()
+            self._total_segments = sum(len(segments) for segments in self._by_journey.values())
+            self._is_empty = self._total_segments == 0
+            # Every final-delay query starts from the same per-journey
+            # frame; the stats pass below materializes it
+            self._final_df = self._get_final_delays_df().persist(storage_level)
+            # Parameterless aggregations the dashboard polls on every
+            # refresh are computed once per loaded snapshot. Overall and
+            # per-line stats share one pass over the final delays; the
+            # heatmap aggregates every segment, so it needs its own.
+            self._delay_stats, self._stats_by_line = self._compute_final_delay_stats()
+            self._total_journeys = self._delay_stats["total_journeys"]
+            self._heatmap = self._compute_heatmap()
+            self._unique_lines = self._compute_unique_lines()
+            logger.info(
+                "Loaded %d segment records (%d journeys) via Spark",
+                self._total_segments, self._total_journeys
+            )
             
         except Exception as e:
             logger.error("Error loading data with Spark: %s", e)
-            # Create empty DataFrame with schema
-            self._df = self.spark.createDataFrame([], schema=StructType([
-                StructField("journey_id", StringType(), True),
-                StructField("line", StringType(), True),
-                StructField("direction", StringType(), True),
-                StructField("line_type", StringType(), True),
-                StructField("vehicle_type", StringType(), True),
-                StructField("start_station", StringType(), True),
-                StructField("start_station_key", StringType(), True),
-                StructField("end_station", StringType(), True),
-                StructField("end_station_key", StringType(), True),
-                StructField("delay_minutes", IntegerType(), True),
-                StructField("start_timestamp", LongType(), True),
-            ]))
+            self._reset_state()
+    
+    def _build_journey_index(self) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Index segments by journey_id for the journey detail view.
+        
+        Built once per load so single-journey lookups are a dict access
+        instead of a Spark filter job over the whole table.
+        """
+        segments = collect_records(
+            self._df.select(
+                "journey_id", "line", "direction", "vehicle_type", "line_type",
+                "start_station", "end_station", "start_timestamp", "delay_minutes",
+                delay_status(coalesce(col("delay_minutes"), lit(0))).alias("status")
+            ).orderBy("journey_id", "start_timestamp")
+        )
+        
+        index: Dict[str, List[Dict[str, Any]]] = {}
+        for segment in segments:
+            index.setdefault(segment["journey_id"], []).append(segment)
+        return index
     
     def _get_final_delays_df(self, df=None):
         """
@@ -176,21 +436,22 @@ class SparkHistoryManager:
         
         The last segment's delay represents the final delay of the journey,
         since each segment shows the current delay at that point in time.
+        Without an explicit frame, returns the cached result for the full
+        table once it has been computed.
         """
         if df is None:
+            if self._final_df is not None:
+                return self._final_df
             df = self._df
         
-        if df.isEmpty():
-            return df
-        
-        # Window to identify the last segment per journey (by timestamp)
-        window = Window.partitionBy("journey_id").orderBy(desc("start_timestamp"))
-        
-        # Add row number and filter to keep only the last segment (row_num = 1)
-        return df.withColumn("_rn", row_number().over(window)) \
-                 .filter(col("_rn") == 1) \
-                 .drop("_rn")
+        # Keep the whole row with the latest start_timestamp per journey:
+        # a single hash aggregate instead of a sorted window per partition
+        last_segment = max_by(struct(*df.columns), "start_timestamp")
+        return df.groupBy("journey_id") \
+                 .agg(last_segment.alias("_last")) \
+                 .select("_last.*")
     
+    @cached_result
     def get_all_journeys(
         self,
         limit: int = 100,
@@ -199,22 +460,49 @@ class SparkHistoryManager:
         vehicle_type: Optional[str] = None
     ) -> Dict[str, Any]:
         """Get journeys with pagination using Spark."""
+        if self._is_empty:
+            return {
+                "journeys": [],
+                "total": 0,
+                "limit": limit,
+                "offset": offset,
+                "has_more": False
+            }
+        
         df = self._df
-        has_filters = line is not None or vehicle_type is not None
+        signature = self._data_signature
+        filters = (line or None, vehicle_type or None)
         
         if line:
             df = df.filter(col("line") == line)
         if vehicle_type:
             df = df.filter(col("vehicle_type") == vehicle_type)
         
-        total = df.count() if has_filters else (self._cached_count or df.count())
-        
-        window = Window.orderBy("start_timestamp")
-        paginated = df.withColumn("_row_num", row_number().over(window)) \
-                      .filter((col("_row_num") > offset) & (col("_row_num") <= offset + limit)) \
-                      .drop("_row_num")
-        
-        journeys = paginated.collect()
+        if filters == (None, None):
+            total = self._total_segments
+        else:
+            # Count each filter combination only once per loaded snapshot;
+            # keyed by signature so a count still running against data a
+            # load replaced is never served for the new data
+            filter_key = (signature, *filters)
+            with self._totals_lock:
+                if filter_key not in self._filtered_totals:
+                    self._filtered_totals[filter_key] = df.count()
+                total = self._filtered_totals[filter_key]
+        
+        # Tie-break on journey_id so pages are stable across requests
+        df = df.drop("is_delayed")
+        order = ["start_timestamp", "journey_id"]
+        if offset + limit <= TOP_K_MAX_ROWS:
+            # orderBy + limit plans as TakeOrderedAndProject: each partition
+            # keeps a bounded heap instead of sorting the whole table
+            journeys = df.orderBy(*order).limit(offset + limit).collect()[offset:]
+        else:
+            window = Window.orderBy(*order)
+            journeys = df.withColumn("_row_num", row_number().over(window)) \
+                         .filter(col("_row_num").between(offset + 1, offset + limit)) \
+                         .drop("_row_num") \
+                         .collect()
         
         return {
             "journeys": [row.asDict() for row in journeys],
@@ -226,96 +514,85 @@ class SparkHistoryManager:
     
     def get_delay_stats(self) -> Dict[str, Any]:
         """
-        Calculate overall delay statistics using Spark aggregations.
+        Get overall delay statistics.
         
         Uses the final delay of each journey (last segment) for calculations,
         since each segment shows the current delay at that point in time.
+        Precomputed in _load_data; see _compute_final_delay_stats.
         """
-        if self._df.isEmpty():
-            return {
-                "delay_minutes": 0,
-                "max_delay_minutes": 0,
-                "min_delay_minutes": 0,
-                "delayed_percentage": 0,
-                "total_journeys": 0,
-                "total_segments": 0
-            }
-        
-        # Get final delays (last segment per journey)
-        final_delays_df = self._get_final_delays_df()
-        
-        # Use Spark aggregations on final delays
-        stats = final_delays_df.agg(
-            avg("delay_minutes").alias("avg_delay"),
-            spark_max("delay_minutes").alias("max_delay"),
-            spark_min("delay_minutes").alias("min_delay"),
-            count("*").alias("total_journeys"),
-            spark_sum(when(col("delay_minutes") > 2, 1).otherwise(0)).alias("delayed_count")
-        ).collect()[0]
-        
-        total_segments = self._cached_count or self._df.count()
-        total_journeys = stats["total_journeys"] or 0
-        delayed_count = stats["delayed_count"] or 0
-        
-        return {
-            "delay_minutes": round(float(stats["avg_delay"] or 0), 2),
-            "max_delay_minutes": int(stats["max_delay"] or 0),
-            "min_delay_minutes": int(stats["min_delay"] or 0),
-            "delayed_percentage": round((delayed_count / total_journeys) * 100, 1) if total_journeys > 0 else 0,
-            "total_journeys": total_journeys,
-            "total_segments": total_segments
-        }
+        return self._delay_stats
     
     def get_stats_by_line(self) -> List[Dict[str, Any]]:
         """
-        Get delay statistics grouped by line using Spark.
+        Get delay statistics grouped by line.
         
-        Uses the final delay of each journey (last segment) for calculations.
+        Precomputed in _load_data; see _compute_final_delay_stats.
         """
-        if self._df.isEmpty():
-            return []
+        return self._stats_by_line
+    
+    def _compute_final_delay_stats(self):
+        """
+        Aggregate final journey delays overall and per line in one pass.
+        
+        A rollup over (line, vehicle_type, line_type) yields the per-line
+        rows (grouping id 0) and the grand total (grouping id 7) from a
+        single scan of the final-delays frame; the intermediate rollup
+        levels are filtered out before collecting.
+        
+        Returns:
+            Tuple of (overall stats dict, per-line stats list)
+        """
+        if self._is_empty:
+            return dict(EMPTY_DELAY_STATS), []
         
         # Get final delays (last segment per journey)
         final_delays_df = self._get_final_delays_df()
         
-        # Group by line and aggregate final delays
-        line_stats = final_delays_df.groupBy("line", "vehicle_type", "line_type").agg(
+        grouped = final_delays_df.rollup("line", "vehicle_type", "line_type").agg(
+            grouping_id().alias("_grouping"),
             avg("delay_minutes").alias("avg_delay"),
             spark_max("delay_minutes").alias("max_delay"),
+            spark_min("delay_minutes").alias("min_delay"),
             count("*").alias("total_journeys"),
-            spark_sum(when(col("delay_minutes") > 2, 1).otherwise(0)).alias("delayed_count")
-        ).collect()
-        
-        result = []
-        for row in line_stats:
-            delay = float(row["avg_delay"] or 0)
-            total = row["total_journeys"] or 0
-            delayed = row["delayed_count"] or 0
-            delayed_pct = (delayed / total) * 100 if total > 0 else 0
-            
-            # Determine status
-            if delay < 2:
-                status = "good"
-            elif delay < 5:
-                status = "warning"
+            spark_sum("is_delayed").alias("delayed_count")
+        ).filter(col("_grouping").isin(0, 7))
+        
+        # Shape the response rows (rounding, status) inside Spark
+        avg_delay = coalesce(col("avg_delay"), lit(0.0))
+        rows = collect_records(grouped.select(
+            col("_grouping"),
+            col("line"),
+            col("vehicle_type"),
+            col("line_type"),
+            spark_round(avg_delay, 2).alias("delay_minutes"),
+            coalesce(col("max_delay"), lit(0)).alias("max_delay_minutes"),
+            coalesce(col("min_delay"), lit(0)).alias("min_delay_minutes"),
+            spark_round(col("delayed_count") / col("total_journeys") * 100, 1).alias("delayed_percentage"),
+            col("total_journeys"),
+            delay_status(avg_delay).alias("status")
+        ))
+        
+        overall = dict(EMPTY_DELAY_STATS)
+        line_stats = []
+        for row in rows:
+            if row.pop("_grouping") == 7:
+                overall.update({
+                    "delay_minutes": row["delay_minutes"],
+                    "max_delay_minutes": row["max_delay_minutes"],
+                    "min_delay_minutes": row["min_delay_minutes"],
+                    "delayed_percentage": row["delayed_percentage"] or 0,
+                    "total_journeys": row["total_journeys"],
+                    "total_segments": self._total_segments
+                })
             else:
-                status = "critical"
-            
-            result.append({
-                "line": row["line"],
-                "vehicle_type": row["vehicle_type"],
-                "line_type": row["line_type"],
-                "delay_minutes": round(delay, 2),
-                "max_delay_minutes": int(row["max_delay"] or 0),
-                "delayed_percentage": round(delayed_pct, 1),
-                "total_journeys": total,
-                "status": status
-            })
+                row.pop("min_delay_minutes")
+                line_stats.append(row)
         
         # Sort by delay descending
-        result.sort(key=lambda x: x["delay_minutes"], reverse=True)
-        return result
+        line_stats.sort(key=lambda x: x["delay_minutes"], reverse=True)
+        return overall, line_stats
     
+    @cached_result
     def get_delays_over_time(
         self,
         hours: int = 24,
@@ -324,29 +601,28 @@ class SparkHistoryManager:
         """
         Get delay data bucketed over time using Spark.
         """
-        if self._df.isEmpty():
+        if self._is_empty:
             return []
         
         bucket_seconds = bucket_minutes * 60
         
-        # Create time buckets and aggregate
+        # Bucket on the integer epoch and format only the aggregated
+        # buckets, so the timestamp-to-string conversion runs once per
+        # bucket instead of once per segment
         bucketed = self._df \
             .withColumn(
                 "bucket_ts",
                 (floor(col("start_timestamp") / bucket_seconds) * bucket_seconds)
             ) \
-            .withColumn(
-                "bucket_time",
-                from_unixtime(col("bucket_ts"))
-            ) \
-            .groupBy("bucket_time") \
+            .groupBy("bucket_ts") \
             .agg(
                 avg("delay_minutes").alias("avg_delay"),
                 spark_max("delay_minutes").alias("max_delay"),
                 spark_min("delay_minutes").alias("min_delay"),
                 count("*").alias("count")
             ) \
-            .orderBy("bucket_time") \
+            .withColumn("bucket_time", from_unixtime(col("bucket_ts"))) \
+            .orderBy("bucket_ts") \
             .collect()
         
         return [
@@ -361,79 +637,87 @@ class SparkHistoryManager:
         ]
     
     def get_unique_lines(self) -> List[Dict[str, str]]:
-        """Get list of unique lines using Spark."""
-        if self._df.isEmpty():
-            return []
+        """
+        Get list of unique lines.
         
-        lines = self._df \
-            .select("line", "vehicle_type", "line_type", "direction") \
-            .dropDuplicates(["line"]) \
-            .collect()
+        Precomputed in _load_data; see _compute_unique_lines.
+        """
+        return self._unique_lines
+    
+    def _compute_unique_lines(self) -> List[Dict[str, str]]:
+        """
+        Derive the unique lines from the journey index.
         
-        return sorted(
-            [
-                {
-                    "name": row["line"],
-                    "vehicle_type": row["vehicle_type"],
-                    "line_type": row["line_type"],
-                    "direction": row["direction"]
-                }
-                for row in lines
-            ],
-            key=lambda x: x["name"] or ""
-        )
+        Every segment is already on the driver in _by_journey, so the first
+        row seen per line is taken there instead of running a Spark shuffle.
+        """
+        lines: Dict[Any, Dict[str, str]] = {}
+        for segments in self._by_journey.values():
+            for row in segments:
+                if row["line"] not in lines:
+                    lines[row["line"]] = {
+                        "name": row["line"],
+                        "vehicle_type": row["vehicle_type"],
+                        "line_type": row["line_type"],
+                        "direction": row["direction"]
+                    }
+        
+        return sorted(lines.values(), key=lambda x: x["name"] or "")
     
     def get_heatmap_data(self) -> List[Dict[str, Any]]:
         """
         Get delay data aggregated by hour of day and day of week.
         
+        Precomputed in _load_data; see _compute_heatmap.
+        """
+        return self._heatmap
+    
+    def _compute_heatmap(self) -> List[Dict[str, Any]]:
+        """
+        Get delay data aggregated by hour of day and day of week.
+        
         Returns a grid for heatmap visualization:
         - X-axis: Hour (0-23)
         - Y-axis: Day of week (1=Sunday, 7=Saturday)
         """
-        if self._df.isEmpty():
+        if self._is_empty:
             return []
         
-        # Extract hour and day of week from timestamp
+        # Convert the epoch seconds once and derive hour and day of week
+        # from the shared timestamp column
         heatmap_data = self._df \
-            .withColumn("hour_of_day", hour(from_unixtime(col("start_timestamp")))) \
-            .withColumn("day_of_week", dayofweek(from_unixtime(col("start_timestamp")))) \
+            .withColumn("_start_ts", timestamp_seconds(col("start_timestamp"))) \
+            .withColumn("hour_of_day", hour("_start_ts")) \
+            .withColumn("day_of_week", dayofweek("_start_ts")) \
             .groupBy("hour_of_day", "day_of_week") \
             .agg(
                 avg("delay_minutes").alias("avg_delay"),
                 spark_max("delay_minutes").alias("max_delay"),
                 count("*").alias("count"),
-                spark_sum(when(col("delay_minutes") > 2, 1).otherwise(0)).alias("delayed_count")
+                spark_sum("is_delayed").alias("delayed_count")
+            )
+        
+        # Map day numbers to names and finish the row shape inside Spark,
+        # so the driver only has to convert rows to dicts
+        day_name = when(col("day_of_week").isNull(), lit("Unknown"))
+        for day, name in DAY_NAMES.items():
+            day_name = day_name.when(col("day_of_week") == day, lit(name))
+        
+        heatmap_data = heatmap_data \
+            .select(
+                col("hour_of_day").alias("hour"),
+                col("day_of_week"),
+                day_name.otherwise(lit("Unknown")).alias("day_name"),
+                spark_round(coalesce(col("avg_delay"), lit(0.0)), 2).alias("avg_delay"),
+                coalesce(col("max_delay"), lit(0)).alias("max_delay"),
+                col("count"),
+                spark_round(col("delayed_count") / col("count") * 100, 1).alias("delayed_percentage")
             ) \
-            .orderBy("day_of_week", "hour_of_day") \
-            .collect()
-        
-        # Map day numbers to names
-        day_names = {
-            1: "Sonntag",
-            2: "Montag", 
-            3: "Dienstag",
-            4: "Mittwoch",
-            5: "Donnerstag",
-            6: "Freitag",
-            7: "Samstag"
-        }
+            .orderBy("day_of_week", "hour")
         
-        return [
-            {
-                "hour": row["hour_of_day"],
-                "day_of_week": row["day_of_week"],
-                "day_name": day_names.get(row["day_of_week"], "Unknown"),
-                "avg_delay": round(float(row["avg_delay"] or 0), 2),
-                "max_delay": int(row["max_delay"] or 0),
-                "count": row["count"],
-                "delayed_percentage": round(
-                    (row["delayed_count"] / row["count"]) * 100, 1
-                ) if row["count"] > 0 else 0
-            }
-            for row in heatmap_data
-        ]
+        return collect_records(heatmap_data)
     
+    @cached_result
     def get_journeys_by_line(
         self,
         line: str,
@@ -445,20 +729,15 @@ class SparkHistoryManager:
         Returns journeys with the final delay (last segment's delay),
         since each segment shows the current delay at that point in time.
         """
-        if self._df.isEmpty():
+        if self._is_empty:
             return {"line": line, "journeys": [], "total": 0}
         
-        # Filter by line
+        # Filter by line; an unknown line simply yields no journeys below
         line_df = self._df.filter(col("line") == line)
         
-        if line_df.isEmpty():
-            return {"line": line, "journeys": [], "total": 0}
-        
-        # Get final delays (last segment per journey)
-        final_delays_df = self._get_final_delays_df(line_df)
-        
-        # Get journey metadata by grouping all segments
-        journey_meta = line_df.groupBy(
+        # One pass per journey: metadata aggregates plus the final
+        # segment's delay and end station, picked by latest start_timestamp
+        journeys_df = line_df.groupBy(
             "journey_id", "line", "direction", "vehicle_type", "line_type"
         ).agg(
             spark_max("delay_minutes").alias("max_delay"),
@@ -466,59 +745,41 @@ class SparkHistoryManager:
             count("*").alias("segment_count"),
             first("start_station").alias("first_station"),
             spark_min("start_timestamp").alias("start_time"),
-            spark_max("start_timestamp").alias("end_time")
-        )
-        
-        # Join to get final delay and last station from final segment
-        journeys_df = journey_meta.join(
-            final_delays_df.select(
-                col("journey_id").alias("fj_id"),
-                col("delay_minutes").alias("final_delay"),
-                col("end_station").alias("last_station")
-            ),
-            journey_meta.journey_id == col("fj_id"),
-            "left"
-        ).drop("fj_id").orderBy(col("start_time").desc())
-        
-        total = journeys_df.count()
-        journeys = journeys_df.limit(limit).collect()
-        
-        result = []
-        for row in journeys:
-            delay = float(row["final_delay"] or 0)
-            
-            # Determine status
-            if delay < 2:
-                status = "good"
-            elif delay < 5:
-                status = "warning"
-            else:
-                status = "critical"
-            
-            result.append({
-                "journey_id": row["journey_id"],
-                "line": row["line"],
-                "direction": row["direction"],
-                "vehicle_type": row["vehicle_type"],
-                "line_type": row["line_type"],
-                "delay_minutes": round(delay, 2),
-                "max_delay_minutes": int(row["max_delay"] or 0),
-                "min_delay_minutes": int(row["min_delay"] or 0),
-                "segment_count": row["segment_count"],
-                "first_station": row["first_station"],
-                "last_station": row["last_station"],
-                "start_time": row["start_time"],
-                "end_time": row["end_time"],
-                "status": status
-            })
+            spark_max("start_timestamp").alias("end_time"),
+            max_by(struct("delay_minutes", "end_station"), "start_timestamp").alias("final")
+        ).orderBy(col("start_time").desc())
+        
+        # Shape the response rows (rounding, status) inside Spark
+        final_delay = coalesce(col("final.delay_minutes"), lit(0)).cast("double")
+        journeys = collect_records(journeys_df.limit(limit).select(
+            col("journey_id"),
+            col("line"),
+            col("direction"),
+            col("vehicle_type"),
+            col("line_type"),
+            spark_round(final_delay, 2).alias("delay_minutes"),
+            coalesce(col("max_delay"), lit(0)).alias("max_delay_minutes"),
+            coalesce(col("min_delay"), lit(0)).alias("min_delay_minutes"),
+            col("segment_count"),
+            col("first_station"),
+            col("final.end_station").alias("last_station"),
+            col("start_time"),
+            col("end_time"),
+            delay_status(final_delay).alias("status")
+        ))
+        
+        # A short page already holds every journey; only a full page needs
+        # a separate count for the total
+        total = len(journeys) if len(journeys) < limit else journeys_df.count()
         
         return {
             "line": line,
-            "journeys": result,
+            "journeys": journeys,
             "total": total,
             "limit": limit
         }
     
+    @cached_result
     def get_segments_with_delay(self, limit: int = 100, sort_by: str = "avg_delay") -> List[Dict[str, Any]]:
         """
         Get aggregated delay statistics for each unique segment.
@@ -532,86 +793,70 @@ class SparkHistoryManager:
         
         Returns segments sorted by the specified metric (descending).
         """
-        if self._df.isEmpty():
+        if self._is_empty:
             return []
         
         # Group by start and end station (using keys for unique identification)
-        segment_stats = self._df.groupBy(
-            "start_station",
-            "start_station_key", 
-            "end_station",
-            "end_station_key"
-        ).agg(
+        segment_keys = ["start_station", "start_station_key", "end_station", "end_station_key"]
+        segment_stats = self._df.groupBy(*segment_keys).agg(
             avg("delay_minutes").alias("avg_delay"),
             spark_max("delay_minutes").alias("max_delay"),
             spark_min("delay_minutes").alias("min_delay"),
             count("*").alias("total_trips"),
-            spark_sum(when(col("delay_minutes") > 2, 1).otherwise(0)).alias("delayed_count"),
-            spark_sum("delay_minutes").alias("total_delay"),  # Summierte Verspätung
-            collect_set("line").alias("lines_set")
+            spark_sum("is_delayed").alias("delayed_count"),
+            spark_sum("delay_minutes").alias("total_delay")  # Summierte Verspätung
         )
         
         # Sort by specified metric
         if sort_by == "max_delay":
-            segment_stats = segment_stats.orderBy(desc("max_delay"))
+            sort_col = desc("max_delay")
         elif sort_by == "total_delay":
-            segment_stats = segment_stats.orderBy(desc("total_delay"))
+            sort_col = desc("total_delay")
         else:  # Default: avg_delay
-            segment_stats = segment_stats.orderBy(desc("avg_delay"))
-        
-        segment_stats = segment_stats.limit(limit)
-        
-        rows = segment_stats.collect()
-        
-        result = []
-        for row in rows:
-            avg_delay = float(row["avg_delay"] or 0)
-            total_trips = row["total_trips"] or 0
-            delayed_count = row["delayed_count"] or 0
-            delayed_pct = (delayed_count / total_trips) * 100 if total_trips > 0 else 0
-            
-            # Determine status based on average delay
-            if avg_delay < 2:
-                status = "good"
-            elif avg_delay < 5:
-                status = "warning"
-            else:
-                status = "critical"
-            
-            # Convert lines set to sorted list
-            lines = sorted(list(row["lines_set"])) if row["lines_set"] else []
-            
-            result.append({
-                "start_station": row["start_station"],
-                "start_station_key": row["start_station_key"],
-                "end_station": row["end_station"],
-                "end_station_key": row["end_station_key"],
-                "avg_delay": round(avg_delay, 2),
-                "max_delay": int(row["max_delay"] or 0),
-                "min_delay": int(row["min_delay"] or 0),
-                "total_delay": round(float(row["total_delay"] or 0), 1),  # Summierte Verspätung
-                "total_trips": total_trips,
-                "delayed_percentage": round(delayed_pct, 1),
-                "lines": lines,
-                "status": status
-            })
+            sort_col = desc("avg_delay")
+        top_segments = segment_stats.orderBy(sort_col).limit(limit)
+        
+        # Lines per segment in a second, light stage: distinct() shrinks the
+        # input to one row per (segment, line) before the list is built, and
+        # only the returned top segments are looked up
+        segment_lines = self._df.select(*segment_keys, "line").distinct() \
+            .groupBy(*segment_keys) \
+            .agg(collect_list("line").alias("lines_set"))
+        lines_match = [top_segments[k].eqNullSafe(segment_lines[k]) for k in segment_keys]
+        segment_stats = top_segments.join(segment_lines, lines_match, "left") \
+            .select(top_segments["*"], segment_lines["lines_set"]) \
+            .orderBy(sort_col)
+        
+        # Shape the response rows (rounding, status, sorted lines) inside Spark
+        avg_delay = coalesce(col("avg_delay"), lit(0.0))
+        rows = segment_stats.select(
+            col("start_station"),
+            col("start_station_key"),
+            col("end_station"),
+            col("end_station_key"),
+            spark_round(avg_delay, 2).alias("avg_delay"),
+            coalesce(col("max_delay"), lit(0)).alias("max_delay"),
+            coalesce(col("min_delay"), lit(0)).alias("min_delay"),
+            spark_round(coalesce(col("total_delay"), lit(0)).cast("double"), 1).alias("total_delay"),  # Summierte Verspätung
+            col("total_trips"),
+            spark_round(col("delayed_count") / col("total_trips") * 100, 1).alias("delayed_percentage"),
+            array_sort(col("lines_set")).alias("lines"),
+            delay_status(avg_delay).alias("status")
+        ).collect()
         
-        return result
+        # Rows rather than collect_records(): the lines array should arrive
+        # as a plain list, not a numpy array
+        return [row.asDict() for row in rows]
 
     def get_journey_segments(self, journey_id: str) -> Dict[str, Any]:
         """
         Get all segments for a specific journey.
         
         Returns detailed segment information for journey detail view.
+        Served from the journey index built at load time, already ordered
+        by start_timestamp.
         """
-        if self._df.isEmpty():
-            return {"journey_id": journey_id, "segments": []}
-        
-        # Filter by journey_id
-        segments_df = self._df.filter(col("journey_id") == journey_id) \
-            .orderBy("start_timestamp")
-        
-        segments = segments_df.collect()
+        segments = self._by_journey.get(journey_id)
         
         if not segments:
             return {"journey_id": journey_id, "segments": []}
@@ -635,9 +880,7 @@ class SparkHistoryManager:
                     "end_station": row["end_station"],
                     "start_timestamp": row["start_timestamp"],
                     "delay_minutes": row["delay_minutes"],
-                    "status": "good" if (row["delay_minutes"] or 0) < 2 
-                              else "warning" if (row["delay_minutes"] or 0) < 5 
-                              else "critical"
+                    "status": row["status"]
                 }
                 for row in segments
             ],
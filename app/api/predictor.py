@@ -7,14 +7,30 @@ Can be used standalone or integrated with a web framework.
 
 import json
 import logging
+import threading
+import zlib
 import joblib
 import numpy as np
+from collections import OrderedDict
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Sequence, Union
+
+try:
+    import onnxruntime as ort
+except ImportError:  # Optional: predictions fall back to the joblib models
+    ort = None
 
 logger = logging.getLogger(__name__)
 
+# Most recent feature vectors whose model outputs are kept in memory
+PREDICTION_CACHE_SIZE = 4096
+
+# Hours counted as rush hour (7-9, 16-19) and weekend days in Spark's
+# dayofweek numbering (1=Sunday, 7=Saturday), matching the training features
+RUSH_HOURS = frozenset({7, 8, 9, 16, 17, 18, 19})
+WEEKEND_DAYS = frozenset({1, 7})
+
 
 class DelayPredictor:
     """
@@ -38,16 +54,33 @@ class DelayPredictor:
             model_dir: Directory containing .pkl model files and config
         """
         self.model_dir = Path(model_dir)
-        self.regressor = None
-        self.classifier = None
+        self._reg_path: Optional[Path] = None
+        self._clf_path: Optional[Path] = None
+        self._regressor = None
+        self._classifier = None
+        self._load_lock = threading.Lock()
         self.feature_config = None
         self.reg_metadata = None
         self.clf_metadata = None
+        self._reg_session = None
+        self._clf_session = None
+        self._class_labels: Optional[np.ndarray] = None
+        self._feature_plan: List[tuple] = []
+        self._prediction_cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_hits = 0
+        self._cache_misses = 0
         
         self._load_models()
     
     def _load_models(self):
-        """Load models and configuration."""
+        """
+        Load configuration and locate models.
+        
+        The pickled models are only unpickled on first use (see the
+        regressor/classifier properties), so an API that only serves one
+        model, or serves both through ONNX Runtime, never pays for the other.
+        """
         # Load feature config
         config_path = self.model_dir / "feature_config.json"
         if config_path.exists():
@@ -55,11 +88,16 @@ class DelayPredictor:
                 self.feature_config = json.load(f)
         else:
             raise FileNotFoundError(f"Feature config not found: {config_path}")
+        self._feature_plan = self._build_feature_plan(
+            self.feature_config["feature_columns"],
+            self.feature_config.get("category_labels", {})
+        )
         
         # Load regression model
         reg_path = self.model_dir / "delay_regressor.pkl"
         if reg_path.exists():
-            self.regressor = joblib.load(reg_path)
+            self._reg_path = reg_path
+            self._reg_session = self._load_onnx_session(self.model_dir / "delay_regressor.onnx")
             
             meta_path = self.model_dir / "delay_regressor_metadata.json"
             if meta_path.exists():
@@ -69,24 +107,138 @@ class DelayPredictor:
         # Load classification model
         clf_path = self.model_dir / "delay_classifier.pkl"
         if clf_path.exists():
-            self.classifier = joblib.load(clf_path)
+            self._clf_path = clf_path
+            self._clf_session = self._load_onnx_session(self.model_dir / "delay_classifier.onnx")
             
             meta_path = self.model_dir / "delay_classifier_metadata.json"
             if meta_path.exists():
                 with open(meta_path) as f:
                     self.clf_metadata = json.load(f)
         
-        if self.regressor is None and self.classifier is None:
+        if self._reg_path is None and self._clf_path is None:
             raise FileNotFoundError(f"No models found in {self.model_dir}")
         
         logger.info("Loaded models from %s", self.model_dir)
-        if self.regressor:
+        if self._reg_path:
             mae = self.reg_metadata.get("metrics", {}).get("mae", "N/A")
             logger.info("  Regressor: MAE=%.2f min", mae if isinstance(mae, (int, float)) else 0)
-        if self.classifier:
+        if self._clf_path:
             f1 = self.clf_metadata.get("metrics", {}).get("f1", "N/A")
             logger.info("  Classifier: F1=%.3f", f1 if isinstance(f1, (int, float)) else 0)
     
+    def _load_pickled_model(self, path: Optional[Path], attr: str):
+        """
+        Unpickle a model into attr once, even under concurrent first use.
+        
+        The file is opened with mmap_mode="r", so arrays that survive
+        unpickling as-is stay memory-mapped and several API worker processes
+        share one page-cached copy. That holds for the histogram boosting
+        models' node arrays; scikit-learn's decision trees (the older random
+        forest pickles) copy their nodes into memory they own while
+        unpickling, so those are loaded privately either way.
+        """
+        if getattr(self, attr) is None and path is not None:
+            with self._load_lock:
+                if getattr(self, attr) is None:
+                    setattr(self, attr, joblib.load(path, mmap_mode="r"))
+        return getattr(self, attr)
+    
+    @property
+    def regressor(self):
+        """Regression model, loaded on first access; None if not trained."""
+        return self._load_pickled_model(self._reg_path, "_regressor")
+    
+    @property
+    def classifier(self):
+        """Classification model, loaded on first access; None if not trained."""
+        return self._load_pickled_model(self._clf_path, "_classifier")
+    
+    def warm_up(self):
+        """
+        Load whatever the prediction path will use and run it once.
+        
+        Pickles are only unpickled for models without an ONNX session, and
+        the first run pays any one-off allocation before real traffic.
+        """
+        X = np.zeros((1, len(self._feature_plan)), dtype=np.float32)
+        if self._reg_path is not None:
+            self._predict_delays(X)
+        if self._clf_path is not None:
+            self._predict_probabilities(X)
+    
+    @property
+    def class_labels(self) -> np.ndarray:
+        """
+        Classifier labels in predict_proba column order.
+        
+        Read from the classifier metadata, so an ONNX-served classifier is
+        never unpickled; models trained before the labels were saved fall
+        back to the pickled classifier's classes_.
+        """
+        if self._class_labels is None:
+            labels = (self.clf_metadata or {}).get("classes")
+            self._class_labels = np.asarray(labels) if labels is not None else self.classifier.classes_
+        return self._class_labels
+    
+    @staticmethod
+    def _load_onnx_session(onnx_path: Path):
+        """
+        Open an onnxruntime session for an exported model, if available.
+        
+        Each session runs single-threaded: concurrency comes from the API's
+        prediction pool, and small batches don't benefit from intra-op
+        threads.
+        """
+        if ort is None or not onnx_path.exists():
+            return None
+        
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = 1
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        logger.info("  Using ONNX Runtime for %s", onnx_path.name)
+        return ort.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+    
+    @staticmethod
+    def _build_feature_plan(feature_cols: List[str], category_labels: Dict[str, List[str]]) -> List[tuple]:
+        """
+        Classify each feature column once as (kind, source key, index map).
+        
+        Kinds: "rush_hour" and "weekend" are derived flags, "idx" is a
+        categorical index read from the base column, "raw" is copied as is.
+        For "idx" columns the index map is the training StringIndexer's
+        label -> index mapping, or None for models trained before the
+        labels were saved.
+        """
+        plan = []
+        for col in feature_cols:
+            if col == "is_rush_hour":
+                plan.append(("rush_hour", None, None))
+            elif col == "is_weekend":
+                plan.append(("weekend", None, None))
+            elif col.endswith("_idx"):
+                base_col = col.replace("_idx", "")
+                labels = category_labels.get(base_col)
+                index_map = {label: i for i, label in enumerate(labels)} if labels else None
+                plan.append(("idx", base_col, index_map))
+            else:
+                plan.append(("raw", col, None))
+        return plan
+    
+    @staticmethod
+    def _encode_category(value, index_map: Optional[Dict[str, int]]) -> int:
+        """
+        Encode a categorical value the way the model was trained.
+        
+        With the training labels, unseen values get the extra index
+        StringIndexer(handleInvalid="keep") reserves for them. Without
+        them, fall back to a stable CRC32 bucket; unlike hash(), it gives
+        the same index in every process.
+        """
+        if index_map is not None:
+            return index_map.get(value, len(index_map))
+        return zlib.crc32(str(value).encode("utf-8")) % 100
+    
     def _prepare_features(self, raw_features: Dict) -> np.ndarray:
         """
         Prepare feature vector from raw input.
@@ -107,33 +259,75 @@ class DelayPredictor:
             "cloud_cover_percent": 50
         }
         """
-        feature_cols = self.feature_config["feature_columns"]
-        
         # Calculate derived features
         hour = raw_features.get("hour_of_day", 12)
         day = raw_features.get("day_of_week", 3)
         
-        is_rush_hour = 1 if (7 <= hour <= 9) or (16 <= hour <= 19) else 0
-        is_weekend = 1 if day in [1, 7] else 0
+        is_rush_hour = int(hour in RUSH_HOURS)
+        is_weekend = int(day in WEEKEND_DAYS)
         
-        # Build feature vector
-        features = []
+        # Fill the feature vector following the plan built at load time
+        features = np.empty((1, len(self._feature_plan)), dtype=np.float32)
+        row = features[0]
         
-        for col in feature_cols:
-            if col == "is_rush_hour":
-                features.append(is_rush_hour)
-            elif col == "is_weekend":
-                features.append(is_weekend)
-            elif col.endswith("_idx"):
-                # Categorical index - use simple hash mapping for now
-                # In production, you'd use the same StringIndexer from training
-                base_col = col.replace("_idx", "")
-                val = raw_features.get(base_col, "unknown")
-                features.append(hash(val) % 100)  # Simple hash encoding
+        for i, (kind, key, index_map) in enumerate(self._feature_plan):
+            if kind == "raw":
+                row[i] = raw_features.get(key, 0)
+            elif kind == "idx":
+                row[i] = self._encode_category(raw_features.get(key, "unknown"), index_map)
+            elif kind == "rush_hour":
+                row[i] = is_rush_hour
             else:
-                features.append(raw_features.get(col, 0))
+                row[i] = is_weekend
         
-        return np.array(features).reshape(1, -1)
+        return features
+    
+    def _cached_prediction(self, model_name: str, X: np.ndarray, predict) -> np.ndarray:
+        """
+        Run predict over the rows of X through an in-process LRU keyed on
+        each row's feature vector; the model only sees the rows that miss.
+        
+        Keying on the prepared vector rather than the raw dict means inputs
+        that differ only in fields the models ignore share an entry.
+        """
+        keys = [(model_name, tuple(row)) for row in X.tolist()]
+        outputs = [None] * len(keys)
+        missing = []
+        with self._cache_lock:
+            for i, key in enumerate(keys):
+                cached = self._prediction_cache.get(key)
+                if cached is None:
+                    missing.append(i)
+                else:
+                    self._prediction_cache.move_to_end(key)
+                    outputs[i] = cached
+            self._cache_hits += len(keys) - len(missing)
+        
+        if missing:
+            computed = predict(X[missing])
+            with self._cache_lock:
+                self._cache_misses += len(missing)
+                for i, value in zip(missing, computed):
+                    outputs[i] = value
+                    self._prediction_cache[keys[i]] = value
+                    self._prediction_cache.move_to_end(keys[i])
+                while len(self._prediction_cache) > PREDICTION_CACHE_SIZE:
+                    self._prediction_cache.popitem(last=False)
+        
+        return np.array(outputs)
+    
+    def _predict_delays(self, X: np.ndarray) -> np.ndarray:
+        """Raw regressor output for a feature matrix."""
+        if self._reg_session is not None:
+            return self._reg_session.run(None, {"X": X})[0].ravel()
+        return self.regressor.predict(X)
+    
+    def _predict_probabilities(self, X: np.ndarray) -> np.ndarray:
+        """Class probabilities (classes_ order) for a feature matrix."""
+        if self._clf_session is not None:
+            # Outputs are [label, probabilities]
+            return self._clf_session.run(None, {"X": X})[1]
+        return self.classifier.predict_proba(X)
     
     def predict_delay(self, features: Dict) -> float:
         """
@@ -145,11 +339,11 @@ class DelayPredictor:
         Returns:
             Predicted delay in minutes
         """
-        if self.regressor is None:
+        if self._reg_path is None:
             raise RuntimeError("Regression model not loaded")
         
         X = self._prepare_features(features)
-        prediction = self.regressor.predict(X)[0]
+        prediction = self._cached_prediction("regressor", X, self._predict_delays)[0]
         
         # Ensure non-negative
         return max(0.0, float(prediction))
@@ -164,21 +358,33 @@ class DelayPredictor:
         Returns:
             Dict with prediction and probability
         """
-        if self.classifier is None:
+        if self._clf_path is None:
             raise RuntimeError("Classification model not loaded")
         
         X = self._prepare_features(features)
-        prediction = self.classifier.predict(X)[0]
-        probabilities = self.classifier.predict_proba(X)[0]
+        probabilities = self._cached_prediction("classifier", X, self._predict_probabilities)
+        
+        return self._classification_results(probabilities)[0]
+    
+    def _classification_results(self, probabilities: np.ndarray) -> List[Dict]:
+        """
+        Build classification result dicts from predict_proba output.
         
+        The predicted class is the most probable one, which is what the
+        model's own predict() computes, so the trees are only walked once.
+        """
+        predictions = self.class_labels.take(np.argmax(probabilities, axis=1))
         threshold = self.clf_metadata.get("metrics", {}).get("delay_threshold", 2)
         
-        return {
-            "is_delayed": bool(prediction),
-            "probability_delayed": float(probabilities[1]),
-            "probability_on_time": float(probabilities[0]),
-            "threshold_minutes": threshold
-        }
+        return [
+            {
+                "is_delayed": bool(prediction),
+                "probability_delayed": float(proba[1]),
+                "probability_on_time": float(proba[0]),
+                "threshold_minutes": threshold
+            }
+            for prediction, proba in zip(predictions, probabilities)
+        ]
     
     def predict_full(self, features: Dict) -> Dict:
         """
@@ -195,10 +401,10 @@ class DelayPredictor:
             "timestamp": datetime.now().isoformat()
         }
         
-        if self.regressor:
+        if self._reg_path:
             result["predicted_delay_minutes"] = self.predict_delay(features)
         
-        if self.classifier:
+        if self._clf_path:
             result["classification"] = self.predict_is_delayed(features)
         
         return result
@@ -207,29 +413,89 @@ class DelayPredictor:
         """
         Predict for multiple inputs.
         
+        All inputs are stacked into one feature matrix, so each model runs
+        a single predict call for the whole batch instead of one per input.
+        
         Args:
             feature_list: List of feature dictionaries
             
         Returns:
             List of prediction results
         """
-        return [self.predict_full(f) for f in feature_list]
+        if not feature_list:
+            return []
+        
+        X = np.vstack([self._prepare_features(f) for f in feature_list])
+        timestamp = datetime.now().isoformat()
+        results = [
+            {"input_features": features, "timestamp": timestamp}
+            for features in feature_list
+        ]
+        return self._predict_matrix(X, results)
+    
+    def predict_batch_arrays(self, shared_features: Dict, categories: Dict[str, Sequence]) -> List[Dict]:
+        """
+        Predict for rows that differ only in their categorical features.
+        
+        The shared features are prepared once and repeated into the batch
+        matrix; only the categorical index columns are filled per row.
+        
+        Args:
+            shared_features: Feature values common to every row
+            categories: Categorical column -> one value per row
+            
+        Returns:
+            List of prediction results (without input echo), in row order
+        """
+        n_rows = len(next(iter(categories.values()), ()))
+        if n_rows == 0:
+            return []
+        
+        X = np.repeat(self._prepare_features(shared_features), n_rows, axis=0)
+        for i, (kind, key, index_map) in enumerate(self._feature_plan):
+            if kind == "idx" and key in categories:
+                X[:, i] = [self._encode_category(value, index_map) for value in categories[key]]
+        
+        return self._predict_matrix(X, [{} for _ in range(n_rows)])
+    
+    def _predict_matrix(self, X: np.ndarray, results: List[Dict]) -> List[Dict]:
+        """Add both models' predictions for the rows of X to results."""
+        if self._reg_path:
+            # Ensure non-negative
+            delays = np.maximum(0.0, self._cached_prediction("regressor", X, self._predict_delays))
+            for result, delay in zip(results, delays):
+                result["predicted_delay_minutes"] = float(delay)
+        
+        if self._clf_path:
+            classifications = self._classification_results(
+                self._cached_prediction("classifier", X, self._predict_probabilities)
+            )
+            for result, classification in zip(results, classifications):
+                result["classification"] = classification
+        
+        return results
     
     def get_model_info(self) -> Dict:
         """Get information about loaded models."""
         return {
             "model_dir": str(self.model_dir),
             "regressor": {
-                "loaded": self.regressor is not None,
+                "loaded": self._reg_path is not None,
                 "metrics": self.reg_metadata.get("metrics") if self.reg_metadata else None,
                 "training_date": self.reg_metadata.get("training_date") if self.reg_metadata else None
             },
             "classifier": {
-                "loaded": self.classifier is not None,
+                "loaded": self._clf_path is not None,
                 "metrics": self.clf_metadata.get("metrics") if self.clf_metadata else None,
                 "training_date": self.clf_metadata.get("training_date") if self.clf_metadata else None
             },
-            "feature_columns": self.feature_config.get("feature_columns") if self.feature_config else None
+            "feature_columns": self.feature_config.get("feature_columns") if self.feature_config else None,
+            "prediction_cache": {
+                "size": len(self._prediction_cache),
+                "max_size": PREDICTION_CACHE_SIZE,
+                "hits": self._cache_hits,
+                "misses": self._cache_misses
+            }
         }
 
 
@@ -6,12 +6,16 @@ segment data with GPS coordinates for map visualization.
 """
 
 import os
-import json
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hmac
 import hashlib
 import base64
+import orjson
+from functools import lru_cache
+from pathlib import Path
 from typing import Dict, List, Optional
 
 logger = logging.getLogger(__name__)
@@ -23,12 +27,44 @@ CACHE_FILE = "app/api/cache/stations_cache.json"
 
 _station_lookup: Optional[Dict] = None
 
+# Keep-alive session for Geofox requests. listStations is read-only, so
+# POSTs are safe to retry on connection errors and gateway failures.
+_session = requests.Session()
+_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=10,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"POST"}),
+        ),
+    ),
+)
+
+# Secondary indexes for get_coordinates_for_station_key, rebuilt whenever a
+# different lookup dict is passed in
+_indexed_lookup: Optional[Dict] = None
+_short_key_index: Dict[str, Dict] = {}
+_fuzzy_matches: Dict[str, Optional[Dict]] = {}
+
 
 def get_signature(body_payload: dict, password: str) -> str:
     """Generate HMAC-SHA1 signature for Geofox API authentication."""
-    key = bytes(password, "utf-8")
-    message = bytes(json.dumps(body_payload, separators=(",", ":")), "utf-8")
-    hashed = hmac.new(key, message, hashlib.sha1)
+    return sign_body(orjson.dumps(body_payload).decode("utf-8"), password)
+
+
+@lru_cache(maxsize=16)
+def sign_body(body: str, password: str) -> str:
+    """
+    HMAC-SHA1 signature of an already serialized request body.
+
+    Request bodies are constant (e.g. the station directory request), so
+    signatures are memoized per body and password.
+    """
+    hashed = hmac.new(password.encode("utf-8"), body.encode("utf-8"), hashlib.sha1)
     return base64.b64encode(hashed.digest()).decode("utf-8")
 
 
@@ -37,24 +73,26 @@ def fetch_all_stations() -> Dict:
     logger.info("Fetching station directory from HVV...")
 
     payload = {"version": 62, "coordinateType": "EPSG_4326"}
+    # Serialize once: the signature must cover exactly the bytes sent
+    body = orjson.dumps(payload).decode("utf-8")
 
     headers = {
         "Content-Type": "application/json;charset=UTF-8",
         "Accept": "application/json",
         "geofox-auth-user": GTI_USER,
-        "geofox-auth-signature": get_signature(payload, GTI_PASSWORD),
+        "geofox-auth-signature": sign_body(body, GTI_PASSWORD),
         "geofox-auth-type": "HmacSHA1",
     }
 
     try:
-        response = requests.post(
+        response = _session.post(
             API_URL,
-            data=json.dumps(payload, separators=(",", ":")),
+            data=body,
             headers=headers,
             timeout=30,
         )
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
 
         if data.get("returnCode") != "OK":
             logger.error("HVV API error: %s", data.get("errorText"))
@@ -90,28 +128,47 @@ def get_station_lookup(cache_file: str = CACHE_FILE) -> Dict:
         return _station_lookup
 
     if os.path.exists(cache_file):
-        with open(cache_file, "r", encoding="utf-8") as f:
-            _station_lookup = json.load(f)
-            logger.info("Loaded %d stations from cache", len(_station_lookup))
-            return _station_lookup
+        _station_lookup = orjson.loads(Path(cache_file).read_bytes())
+        logger.info("Loaded %d stations from cache", len(_station_lookup))
+        return _station_lookup
 
     _station_lookup = fetch_all_stations()
 
     if _station_lookup:
         os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-        with open(cache_file, "w", encoding="utf-8") as f:
-            json.dump(_station_lookup, f)
+        Path(cache_file).write_bytes(orjson.dumps(_station_lookup))
         logger.info("Saved stations cache: %s", cache_file)
 
     return _station_lookup
 
 
+def _index_station_lookup(station_lookup: Dict) -> None:
+    """
+    Index station IDs by their part after the last ":" (e.g. "80950").
+
+    Lookups run on several worker threads, so the index is built locally
+    and published whole before _indexed_lookup marks it ready; no thread
+    sees a partial index and remembers a false fuzzy miss.
+    """
+    global _indexed_lookup, _short_key_index
+
+    short_key_index: Dict[str, Dict] = {}
+    for sid, station in station_lookup.items():
+        short_key_index.setdefault(sid.split(":")[-1], station)
+    _fuzzy_matches.clear()
+    _short_key_index = short_key_index
+    _indexed_lookup = station_lookup
+
+
 def get_coordinates_for_station_key(station_key: str, station_lookup: Dict) -> Dict:
     """
     Get coordinates for a station key.
 
     Station keys from segments look like "Master:80950".
-    We try multiple formats to find a match in the lookup.
+    We try multiple formats to find a match in the lookup: the key itself,
+    its short form, and station IDs sharing that short form are all dict
+    lookups. Only keys none of them resolve fall back to a substring scan,
+    whose result is remembered per key.
 
     Returns dict with lat, lon or None values if not found.
     """
@@ -122,17 +179,50 @@ def get_coordinates_for_station_key(station_key: str, station_lookup: Dict) -> D
         station = station_lookup[station_key]
         return {"lat": station["lat"], "lon": station["lon"]}
 
-    if ":" in station_key:
-        short_key = station_key.split(":")[-1]
-        if short_key in station_lookup:
-            station = station_lookup[short_key]
-            return {"lat": station["lat"], "lon": station["lon"]}
+    if station_lookup is not _indexed_lookup:
+        _index_station_lookup(station_lookup)
+
+    short_key = station_key.split(":")[-1]
+    station = station_lookup.get(short_key) or _short_key_index.get(short_key)
+
+    if station is None:
+        if station_key not in _fuzzy_matches:
+            _fuzzy_matches[station_key] = next(
+                (
+                    candidate
+                    for sid, candidate in station_lookup.items()
+                    if station_key in sid or sid in station_key
+                ),
+                None,
+            )
+        station = _fuzzy_matches[station_key]
+
+    if station is None:
+        return {"lat": None, "lon": None}
+    return {"lat": station["lat"], "lon": station["lon"]}
+
 
-    for sid, station in station_lookup.items():
-        if station_key in sid or sid in station_key:
-            return {"lat": station["lat"], "lon": station["lon"]}
+def _resolve_station_coordinates(segments: List[Dict], station_lookup: Dict) -> Dict[str, Dict]:
+    """
+    Look up coordinates once per distinct station key in the segments.
 
-    return {"lat": None, "lon": None}
+    Neighbouring segments share their stations, so there are far fewer
+    distinct keys than segment endpoints.
+    """
+    keys = {segment.get("start_station_key", "") for segment in segments}
+    keys.update(segment.get("end_station_key", "") for segment in segments)
+    return {key: get_coordinates_for_station_key(key, station_lookup) for key in keys}
+
+
+def _with_coordinates(segment: Dict, start_coords: Dict, end_coords: Dict) -> Dict:
+    """Copy a segment dict with its endpoint coordinates added."""
+    return {
+        **segment,
+        "start_lat": start_coords["lat"],
+        "start_lon": start_coords["lon"],
+        "end_lat": end_coords["lat"],
+        "end_lon": end_coords["lon"],
+    }
 
 
 def enrich_segments_with_coordinates(
@@ -154,25 +244,16 @@ def enrich_segments_with_coordinates(
     if station_lookup is None:
         station_lookup = get_station_lookup()
 
-    enriched = []
-    for segment in segments:
-        start_coords = get_coordinates_for_station_key(
-            segment.get("start_station_key", ""), station_lookup
-        )
-        end_coords = get_coordinates_for_station_key(
-            segment.get("end_station_key", ""), station_lookup
-        )
+    coords = _resolve_station_coordinates(segments, station_lookup)
 
-        enriched_segment = {
-            **segment,
-            "start_lat": start_coords["lat"],
-            "start_lon": start_coords["lon"],
-            "end_lat": end_coords["lat"],
-            "end_lon": end_coords["lon"],
-        }
-        enriched.append(enriched_segment)
-
-    return enriched
+    return [
+        _with_coordinates(
+            segment,
+            coords[segment.get("start_station_key", "")],
+            coords[segment.get("end_station_key", "")],
+        )
+        for segment in segments
+    ]
 
 
 def get_segments_with_coordinates(segments: List[Dict]) -> List[Dict]:
@@ -182,16 +263,18 @@ def get_segments_with_coordinates(segments: List[Dict]) -> List[Dict]:
     This is useful for map visualization where we need both start and end coordinates.
     """
     station_lookup = get_station_lookup()
-    enriched = enrich_segments_with_coordinates(segments, station_lookup)
-
-    valid_segments = [
-        seg
-        for seg in enriched
-        if seg["start_lat"] is not None
-        and seg["start_lon"] is not None
-        and seg["end_lat"] is not None
-        and seg["end_lon"] is not None
-    ]
+    coords = _resolve_station_coordinates(segments, station_lookup)
+
+    def has_coordinates(point: Dict) -> bool:
+        return point["lat"] is not None and point["lon"] is not None
+
+    # Check coordinates before copying, so dropped segments are never built
+    valid_segments = []
+    for segment in segments:
+        start_coords = coords[segment.get("start_station_key", "")]
+        end_coords = coords[segment.get("end_station_key", "")]
+        if has_coordinates(start_coords) and has_coordinates(end_coords):
+            valid_segments.append(_with_coordinates(segment, start_coords, end_coords))
 
     return valid_segments
 
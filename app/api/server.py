@@ -6,24 +6,62 @@ Provides REST API endpoints for the Next.js dashboard.
 Run with: uvicorn app.api.server:app --reload --port 8000
 """
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, TypeAdapter
 from typing import Optional, List, Dict, Any
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from contextlib import asynccontextmanager
+import asyncio
 import json
+import logging
+import os
+import time
+import orjson
 
 from .predictor import DelayPredictor, create_features_from_transport_weather
 from .history import get_history_manager
-from .weather_client import get_current_weather, get_weather_impact_level
+from .weather_client import get_current_weather, get_weather_impact_level, close_client
 from .segments import get_segments_with_coordinates
 
+logger = logging.getLogger(__name__)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response rendered with orjson.
+    
+    Endpoints returning large, already JSON-ready payloads return this
+    directly, which also skips FastAPI's jsonable_encoder pass.
+    """
+    
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Load the models before serving the first request and release the
+    shared weather HTTP client on shutdown.
+    """
+    app.state.predictor = await asyncio.to_thread(load_predictor)
+    yield
+    await close_client()
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Hamburg Transit Delay Predictor",
     description="Predict public transport delays based on weather and time features",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=FastJSONResponse,
+    lifespan=lifespan
 )
 
 # CORS for Next.js frontend
@@ -39,22 +77,151 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global predictor instance (lazy loaded)
-_predictor: Optional[DelayPredictor] = None
+# History and segment responses are large, repetitive JSON
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Model inference is CPU-bound; sklearn's tree code releases the GIL, so
+# one worker per core runs predictions in parallel off the event loop
+_prediction_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+
+# History queries block on Spark jobs (or its first data load); a small
+# bounded pool keeps them off the event loop without flooding the local
+# Spark scheduler or starving the default threadpool
+_history_pool = ThreadPoolExecutor(max_workers=4)
+
+
+MODEL_DIR = Path(__file__).parent.parent / "model"
+
+
+def load_predictor() -> Optional[DelayPredictor]:
+    """
+    Load and warm up the predictor, or None if no models are trained.
+    
+    A model that fails to load is logged and also yields None, so only the
+    prediction endpoints answer 503 while history and stats keep working.
+    """
+    if not (MODEL_DIR / "delay_regressor.pkl").exists():
+        return None
+    try:
+        predictor = DelayPredictor(str(MODEL_DIR))
+        predictor.warm_up()
+    except Exception:
+        logger.exception("Failed to load models from %s", MODEL_DIR)
+        return None
+    return predictor
 
 
 def get_predictor() -> DelayPredictor:
-    """Get or create predictor instance."""
-    global _predictor
-    if _predictor is None:
-        model_dir = Path(__file__).parent.parent / "model"
-        if not (model_dir / "delay_regressor.pkl").exists():
-            raise HTTPException(
-                status_code=503,
-                detail="Models not trained yet. Run train_model.py first."
-            )
-        _predictor = DelayPredictor(str(model_dir))
-    return _predictor
+    """Get the predictor loaded at startup."""
+    predictor = getattr(app.state, "predictor", None)
+    if predictor is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Models not trained yet. Run train_model.py first."
+        )
+    return predictor
+
+
+async def run_prediction(func, *args):
+    """Run a blocking predictor call on the prediction pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_prediction_pool, func, *args)
+
+
+class PredictionBatcher:
+    """
+    Coalesce concurrent single predictions into one predict_batch call.
+    
+    Requests are queued; a background task takes the first waiting request,
+    gathers whatever else arrives within max_wait seconds (up to max_batch
+    requests), runs the models once on the stacked inputs and hands each
+    request its own result.
+    """
+    
+    def __init__(self, max_batch: int = 64, max_wait: float = 0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    async def predict(self, features: Dict[str, Any]) -> Dict[str, Any]:
+        """Queue one feature dict and wait for its prediction."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            # Started lazily so the queue and task belong to the serving loop
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run(self._queue))
+        
+        future = loop.create_future()
+        await self._queue.put((features, future))
+        return await future
+    
+    async def _run(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            try:
+                results = await run_prediction(
+                    get_predictor().predict_batch, [features for features, _ in batch]
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), result in zip(batch, results):
+                # Skip requests whose client has already gone away
+                if not future.done():
+                    future.set_result(result)
+
+
+_prediction_batcher = PredictionBatcher()
+
+
+async def run_history(func, *args, **kwargs):
+    """Run a blocking history call on the history pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_history_pool, partial(func, *args, **kwargs))
+
+
+# Aggregated stats only change when new data is loaded; browsers and
+# proxies revalidate with the data signature as ETag
+STATS_CACHE_CONTROL = "public, max-age=60"
+
+
+async def stats_response(request: Request, build) -> Response:
+    """
+    Respond with build(history), or 304 if the client has that data's ETag.
+    
+    The ETag is the history manager's data signature. History is loaded
+    once per process, so the ETag stays fixed until a restart loads new
+    JSONL files.
+    """
+    history = await run_history(get_history_manager)
+    etag = f'"{history.data_signature}"'
+    headers = {"ETag": etag, "Cache-Control": STATS_CACHE_CONTROL}
+    
+    client_etags = {
+        tag.strip().removeprefix("W/")
+        for tag in request.headers.get("if-none-match", "").split(",")
+    }
+    if etag in client_etags or "*" in client_etags:
+        return Response(status_code=304, headers=headers)
+    
+    return FastJSONResponse(build(history), headers=headers)
 
 
 # Request/Response models
@@ -107,6 +274,10 @@ class CombinedPredictionRequest(BaseModel):
     timestamp: Optional[int] = None
 
 
+# Dumps a whole validated batch to plain dicts in one pydantic-core call
+_feature_list_adapter = TypeAdapter(List[PredictionFeatures])
+
+
 # API Endpoints
 
 @app.get("/")
@@ -172,9 +343,10 @@ async def predict(features: PredictionFeatures):
     
     Returns predicted delay in minutes and binary classification.
     """
-    predictor = get_predictor()
+    # Fail with 503 before queueing if the models are missing
+    get_predictor()
     
-    result = predictor.predict_full(features.model_dump())
+    result = await _prediction_batcher.predict(features.model_dump())
     
     return PredictionResponse(
         predicted_delay_minutes=result.get("predicted_delay_minutes"),
@@ -191,7 +363,8 @@ async def predict_combined(request: CombinedPredictionRequest):
     
     Automatically extracts features from the combined data.
     """
-    predictor = get_predictor()
+    # Fail with 503 before queueing if the models are missing
+    get_predictor()
     
     # Convert to feature dict
     features = create_features_from_transport_weather(
@@ -200,7 +373,7 @@ async def predict_combined(request: CombinedPredictionRequest):
         timestamp=request.timestamp
     )
     
-    result = predictor.predict_full(features)
+    result = await _prediction_batcher.predict(features)
     
     return {
         "predicted_delay_minutes": result.get("predicted_delay_minutes"),
@@ -215,7 +388,9 @@ async def predict_batch(feature_list: List[PredictionFeatures]):
     """Batch prediction for multiple journeys."""
     predictor = get_predictor()
     
-    results = predictor.predict_batch([f.model_dump() for f in feature_list])
+    results = await run_prediction(
+        predictor.predict_batch, _feature_list_adapter.dump_python(feature_list)
+    )
     
     return {"predictions": results, "count": len(results)}
 
@@ -227,26 +402,30 @@ async def model_info():
     return predictor.get_model_info()
 
 
+# Static, so it is built once instead of on every request
+MODEL_FEATURES_SCHEMA = {
+    "features": {
+        "line": "Transit line name (e.g., '6', 'U3')",
+        "vehicle_type": "Vehicle type (METROBUS, U_BAHN, etc.)",
+        "line_type": "Line type (BUS, TRAIN)",
+        "direction": "Line direction",
+        "hour_of_day": "Hour (0-23)",
+        "day_of_week": "Day of week (1=Sunday, 7=Saturday)",
+        "temperature_c": "Temperature in Celsius",
+        "precipitation_mm": "Precipitation in mm",
+        "wind_speed_kmh": "Wind speed in km/h",
+        "weather_code": "WMO weather code",
+        "humidity_percent": "Relative humidity %",
+        "cloud_cover_percent": "Cloud cover %"
+    },
+    "example": PredictionFeatures().model_dump()
+}
+
+
 @app.get("/model/features")
 async def model_features():
     """Get the feature schema expected by the model."""
-    return {
-        "features": {
-            "line": "Transit line name (e.g., '6', 'U3')",
-            "vehicle_type": "Vehicle type (METROBUS, U_BAHN, etc.)",
-            "line_type": "Line type (BUS, TRAIN)",
-            "direction": "Line direction",
-            "hour_of_day": "Hour (0-23)",
-            "day_of_week": "Day of week (1=Sunday, 7=Saturday)",
-            "temperature_c": "Temperature in Celsius",
-            "precipitation_mm": "Precipitation in mm",
-            "wind_speed_kmh": "Wind speed in km/h",
-            "weather_code": "WMO weather code",
-            "humidity_percent": "Relative humidity %",
-            "cloud_cover_percent": "Cloud cover %"
-        },
-        "example": PredictionFeatures().model_dump()
-    }
+    return FastJSONResponse(MODEL_FEATURES_SCHEMA)
 
 
 # ============================================================================
@@ -268,13 +447,14 @@ async def get_history_journeys(
     - **line**: Filter by line name (e.g., 'U3', '6')
     - **vehicle_type**: Filter by vehicle type (e.g., 'U_BAHN', 'METROBUS')
     """
-    history = get_history_manager()
-    return history.get_all_journeys(
+    history = await run_history(get_history_manager)
+    return FastJSONResponse(await run_history(
+        history.get_all_journeys,
         limit=limit,
         offset=offset,
         line=line,
         vehicle_type=vehicle_type
-    )
+    ))
 
 
 @app.get("/history/delays")
@@ -288,49 +468,51 @@ async def get_history_delays(
     - **hours**: How many hours of history to return
     - **bucket_minutes**: Size of time buckets in minutes
     """
-    history = get_history_manager()
+    history = await run_history(get_history_manager)
     return {
-        "data": history.get_delays_over_time(hours=hours, bucket_minutes=bucket_minutes),
+        "data": await run_history(
+            history.get_delays_over_time, hours=hours, bucket_minutes=bucket_minutes
+        ),
         "hours": hours,
         "bucket_minutes": bucket_minutes
     }
 
 
 @app.get("/stats/overview")
-async def get_stats_overview():
+async def get_stats_overview(request: Request):
     """
     Get overall dashboard statistics.
     
     Returns aggregated metrics for all historical data.
     """
-    history = get_history_manager()
-    stats = history.get_delay_stats()
-    lines = history.get_unique_lines()
+    def build(history):
+        stats = history.get_delay_stats()
+        lines = history.get_unique_lines()
+        return {
+            **stats,
+            "active_lines": len(lines),
+            "lines": lines,
+            "timestamp": datetime.now().isoformat()
+        }
     
-    return {
-        **stats,
-        "active_lines": len(lines),
-        "lines": lines,
-        "timestamp": datetime.now().isoformat()
-    }
+    return await stats_response(request, build)
 
 
 @app.get("/stats/by-line")
-async def get_stats_by_line():
+async def get_stats_by_line(request: Request):
     """
     Get delay statistics grouped by transit line.
     
     Returns per-line metrics including average delay and status.
     """
-    history = get_history_manager()
-    return {
+    return await stats_response(request, lambda history: {
         "lines": history.get_stats_by_line(),
         "timestamp": datetime.now().isoformat()
-    }
+    })
 
 
 @app.get("/stats/heatmap")
-async def get_stats_heatmap():
+async def get_stats_heatmap(request: Request):
     """
     Get delay data aggregated by hour and day of week.
     
@@ -340,11 +522,10 @@ async def get_stats_heatmap():
     
     Useful for identifying patterns like rush hour delays.
     """
-    history = get_history_manager()
-    return {
+    return await stats_response(request, lambda history: {
         "data": history.get_heatmap_data(),
         "timestamp": datetime.now().isoformat()
-    }
+    })
 
 
 @app.get("/stats/segments")
@@ -364,19 +545,20 @@ async def get_stats_segments(
     - **limit**: Maximum number of segments to return (default 100, max 500)
     - **sort_by**: Sort metric - 'avg_delay' (default), 'max_delay', or 'total_delay'
     """
-    history = get_history_manager()
+    history = await run_history(get_history_manager)
     
     # Get aggregated segment data from Spark
-    segments = history.get_segments_with_delay(limit=limit, sort_by=sort_by)
+    segments = await run_history(history.get_segments_with_delay, limit=limit, sort_by=sort_by)
     
-    # Enrich with coordinates for map visualization
-    segments_with_coords = get_segments_with_coordinates(segments)
+    # Enrich with coordinates for map visualization (the first call may
+    # fetch the station directory over HTTP)
+    segments_with_coords = await run_history(get_segments_with_coordinates, segments)
     
-    return {
+    return FastJSONResponse({
         "segments": segments_with_coords,
         "total": len(segments_with_coords),
         "timestamp": datetime.now().isoformat()
-    }
+    })
 
 
 @app.get("/history/journeys-by-line")
@@ -391,8 +573,10 @@ async def get_journeys_by_line(
     - **line**: Line name (required)
     - **limit**: Maximum number of journeys to return
     """
-    history = get_history_manager()
-    return history.get_journeys_by_line(line=line, limit=limit)
+    history = await run_history(get_history_manager)
+    return FastJSONResponse(
+        await run_history(history.get_journeys_by_line, line=line, limit=limit)
+    )
 
 
 @app.get("/history/journey/{journey_id}")
@@ -402,7 +586,7 @@ async def get_journey_detail(journey_id: str):
     
     Returns all segments with delay information for the detail view.
     """
-    history = get_history_manager()
+    history = await run_history(get_history_manager)
     result = history.get_journey_segments(journey_id)
     
     if not result.get("segments"):
@@ -434,14 +618,51 @@ async def get_weather():
     }
 
 
+# Live predictions only change with the weather (cached for minutes) and
+# the hour of day, so repeated dashboard polls reuse the last response
+LIVE_CACHE_TTL_SECONDS = 60
+
+_live_cache: Optional[Dict[str, Any]] = None
+_live_cache_expires = 0.0
+_live_lock: Optional[asyncio.Lock] = None
+_live_lock_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _get_live_lock() -> asyncio.Lock:
+    """Lock for the running event loop (asyncio locks are loop-bound)."""
+    global _live_lock, _live_lock_loop
+    loop = asyncio.get_running_loop()
+    if _live_lock is None or _live_lock_loop is not loop:
+        _live_lock = asyncio.Lock()
+        _live_lock_loop = loop
+    return _live_lock
+
+
 @app.get("/live/current")
 async def get_live_predictions():
     """
     Get live predictions for current conditions.
     
     Combines current weather with time features to predict delays
-    for all known lines.
+    for all known lines. Responses are reused for LIVE_CACHE_TTL_SECONDS;
+    on a miss, concurrent callers wait for a single computation.
     """
+    global _live_cache, _live_cache_expires
+    if _live_cache is not None and time.monotonic() < _live_cache_expires:
+        return _live_cache
+    
+    async with _get_live_lock():
+        # Another caller may have refreshed the cache while we waited
+        if _live_cache is not None and time.monotonic() < _live_cache_expires:
+            return _live_cache
+        
+        _live_cache = await _build_live_predictions()
+        _live_cache_expires = time.monotonic() + LIVE_CACHE_TTL_SECONDS
+        return _live_cache
+
+
+async def _build_live_predictions() -> Dict[str, Any]:
+    """Compute the /live/current response."""
     # Get current weather
     weather = await get_current_weather()
     impact = get_weather_impact_level(weather)
@@ -452,38 +673,46 @@ async def get_live_predictions():
     day_of_week = (now.isoweekday() % 7) + 1  # Convert to Spark format
     
     # Get all lines from history
-    history = get_history_manager()
+    history = await run_history(get_history_manager)
     lines = history.get_unique_lines()
     
     # Try to get predictor (may not be available if models not trained)
     predictions = []
     try:
         predictor = get_predictor()
+        top_lines = lines[:10]  # Limit to top 10 lines
         
-        for line_info in lines[:10]:  # Limit to top 10 lines
-            features = {
-                "line": line_info["name"],
-                "vehicle_type": line_info["vehicle_type"] or "METROBUS",
-                "line_type": line_info["line_type"] or "BUS",
-                "direction": line_info["direction"] or "unknown",
-                "hour_of_day": hour_of_day,
-                "day_of_week": day_of_week,
-                "temperature_c": weather["temperature_c"],
-                "precipitation_mm": weather["precipitation_mm"],
-                "wind_speed_kmh": weather["wind_speed_kmh"],
-                "weather_code": weather["weather_code"],
-                "humidity_percent": weather["humidity_percent"],
-                "cloud_cover_percent": weather["cloud_cover_percent"]
-            }
-            
-            result = predictor.predict_full(features)
-            predictions.append({
+        # Weather and time are the same for every line; only the
+        # categorical columns vary per row
+        shared_features = {
+            "hour_of_day": hour_of_day,
+            "day_of_week": day_of_week,
+            "temperature_c": weather["temperature_c"],
+            "precipitation_mm": weather["precipitation_mm"],
+            "wind_speed_kmh": weather["wind_speed_kmh"],
+            "weather_code": weather["weather_code"],
+            "humidity_percent": weather["humidity_percent"],
+            "cloud_cover_percent": weather["cloud_cover_percent"]
+        }
+        categories = {
+            "line": [line_info["name"] for line_info in top_lines],
+            "vehicle_type": [line_info["vehicle_type"] or "METROBUS" for line_info in top_lines],
+            "line_type": [line_info["line_type"] or "BUS" for line_info in top_lines],
+            "direction": [line_info["direction"] or "unknown" for line_info in top_lines]
+        }
+        
+        # One vectorized model call for all lines
+        results = await run_prediction(predictor.predict_batch_arrays, shared_features, categories)
+        predictions = [
+            {
                 "line": line_info["name"],
                 "vehicle_type": line_info["vehicle_type"],
                 "predicted_delay_minutes": result.get("predicted_delay_minutes"),
                 "classification": result.get("classification"),
                 "direction": line_info["direction"]
-            })
+            }
+            for line_info, result in zip(top_lines, results)
+        ]
         
         # Sort by predicted delay
         predictions.sort(
@@ -511,5 +740,16 @@ async def get_live_predictions():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Each worker process starts its own Spark driver, so keep the default
+    # at one and scale out with WEB_CONCURRENCY where memory allows.
+    # loop/http "auto" pick uvloop and httptools when they are installed.
+    uvicorn.run(
+        "app.api.server:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        loop="auto",
+        http="auto",
+        log_level="info",
+    )
 
@@ -4,10 +4,15 @@ Weather client for fetching current weather data from Open-Meteo API.
 Provides real-time weather data for Hamburg to use in predictions.
 """
 
+import asyncio
 import logging
+import operator
+import time
 import httpx
+import orjson
 from datetime import datetime
-from typing import Dict, Any, Optional
+from types import MappingProxyType
+from typing import Dict, Any, Mapping, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -15,8 +20,154 @@ HAMBURG_LAT = 53.5511
 HAMBURG_LON = 9.9937
 OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast"
 
+# Open-Meteo's current conditions update every 15 minutes, so dashboard
+# polls within this window share one upstream request
+WEATHER_CACHE_TTL_SECONDS = 300
+
+# WMO weather interpretation codes as returned by Open-Meteo
+WMO_DESCRIPTIONS: Mapping[int, str] = MappingProxyType({
+    0: "Clear sky",
+    1: "Mainly clear",
+    2: "Partly cloudy",
+    3: "Overcast",
+    45: "Foggy",
+    48: "Depositing rime fog",
+    51: "Light drizzle",
+    53: "Moderate drizzle",
+    55: "Dense drizzle",
+    56: "Light freezing drizzle",
+    57: "Dense freezing drizzle",
+    61: "Slight rain",
+    63: "Moderate rain",
+    65: "Heavy rain",
+    66: "Light freezing rain",
+    67: "Heavy freezing rain",
+    71: "Slight snow",
+    73: "Moderate snow",
+    75: "Heavy snow",
+    77: "Snow grains",
+    80: "Slight rain showers",
+    81: "Moderate rain showers",
+    82: "Violent rain showers",
+    85: "Slight snow showers",
+    86: "Heavy snow showers",
+    95: "Thunderstorm",
+    96: "Thunderstorm with slight hail",
+    99: "Thunderstorm with heavy hail"
+})
+
+# Weather impact scoring. Each rule reads one field and walks its
+# (threshold, points, factor) rows in order; the first row whose threshold
+# the value passes scores. A factor of None scores without being listed.
+IMPACT_RULES = (
+    ("temperature_c", 10, operator.lt, (
+        (0, 2, "Freezing temperatures"),
+        (5, 1, "Cold weather"),
+    )),
+    ("temperature_c", 10, operator.gt, (
+        (30, 1, "Heat"),
+    )),
+    ("precipitation_mm", 0, operator.gt, (
+        (5, 3, "Heavy precipitation"),
+        (1, 2, "Moderate precipitation"),
+        (0, 1, "Light precipitation"),
+    )),
+    ("wind_speed_kmh", 0, operator.gt, (
+        (50, 3, "Strong winds"),
+        (30, 2, "Moderate winds"),
+        (20, 1, "Light winds"),
+    )),
+    ("weather_code", 0, operator.ge, (
+        (95, 3, "Thunderstorm"),
+        (71, 2, "Snow"),
+        (61, 1, None),  # Rain
+        (45, 1, "Reduced visibility"),  # Fog
+    )),
+)
+
+# (minimum score, level, description), highest first
+IMPACT_LEVELS = (
+    (6, "high", "Significant delays expected"),
+    (3, "medium", "Some delays possible"),
+    (0, "low", "Normal operations expected"),
+)
+
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+_weather_cache: Optional[Dict[str, Any]] = None
+_weather_cache_expires = 0.0
+_weather_lock: Optional[asyncio.Lock] = None
+_weather_lock_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Shared HTTP client, so keep-alive connections to Open-Meteo are reused.
+    
+    Created on first use for the running event loop; close it on shutdown
+    with close_client().
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            timeout=10.0,
+            limits=httpx.Limits(max_keepalive_connections=10)
+        )
+        _client_loop = loop
+    return _client
+
+
+async def close_client() -> None:
+    """Close the shared HTTP client, if one was created."""
+    global _client, _client_loop
+    if _client is not None:
+        await _client.aclose()
+    _client = None
+    _client_loop = None
+
+
+def _get_weather_lock() -> asyncio.Lock:
+    """Lock for the running event loop (asyncio locks are loop-bound)."""
+    global _weather_lock, _weather_lock_loop
+    loop = asyncio.get_running_loop()
+    if _weather_lock is None or _weather_lock_loop is not loop:
+        _weather_lock = asyncio.Lock()
+        _weather_lock_loop = loop
+    return _weather_lock
+
 
 async def get_current_weather() -> Dict[str, Any]:
+    """
+    Get current weather data for Hamburg.
+    
+    Successful Open-Meteo responses are cached for
+    WEATHER_CACHE_TTL_SECONDS; on a miss, concurrent callers wait for a
+    single upstream request instead of each sending their own. Fallback
+    data is not cached, so the next call retries the API.
+    
+    Returns:
+        Dict with weather data matching the prediction model's expected format
+    """
+    global _weather_cache, _weather_cache_expires
+    
+    if _weather_cache is not None and time.monotonic() < _weather_cache_expires:
+        return _weather_cache
+    
+    async with _get_weather_lock():
+        # Another caller may have refreshed the cache while we waited
+        if _weather_cache is not None and time.monotonic() < _weather_cache_expires:
+            return _weather_cache
+        
+        weather = await fetch_current_weather()
+        if weather["source"] != "fallback":
+            _weather_cache = weather
+            _weather_cache_expires = time.monotonic() + WEATHER_CACHE_TTL_SECONDS
+        return weather
+
+
+async def fetch_current_weather() -> Dict[str, Any]:
     """
     Fetch current weather data for Hamburg from Open-Meteo.
     
@@ -38,10 +189,9 @@ async def get_current_weather() -> Dict[str, Any]:
     }
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(OPEN_METEO_URL, params=params, timeout=10.0)
-            response.raise_for_status()
-            data = response.json()
+        response = await get_client().get(OPEN_METEO_URL, params=params)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
         
         current = data.get("current", {})
         
@@ -83,37 +233,7 @@ def get_weather_description(code: int) -> str:
     Returns:
         Weather description string
     """
-    descriptions = {
-        0: "Clear sky",
-        1: "Mainly clear",
-        2: "Partly cloudy",
-        3: "Overcast",
-        45: "Foggy",
-        48: "Depositing rime fog",
-        51: "Light drizzle",
-        53: "Moderate drizzle",
-        55: "Dense drizzle",
-        56: "Light freezing drizzle",
-        57: "Dense freezing drizzle",
-        61: "Slight rain",
-        63: "Moderate rain",
-        65: "Heavy rain",
-        66: "Light freezing rain",
-        67: "Heavy freezing rain",
-        71: "Slight snow",
-        73: "Moderate snow",
-        75: "Heavy snow",
-        77: "Snow grains",
-        80: "Slight rain showers",
-        81: "Moderate rain showers",
-        82: "Violent rain showers",
-        85: "Slight snow showers",
-        86: "Heavy snow showers",
-        95: "Thunderstorm",
-        96: "Thunderstorm with slight hail",
-        99: "Thunderstorm with heavy hail"
-    }
-    return descriptions.get(code, "Unknown")
+    return WMO_DESCRIPTIONS.get(code, "Unknown")
 
 
 def get_weather_impact_level(weather_data: Dict[str, Any]) -> Dict[str, Any]:
@@ -129,72 +249,27 @@ def get_weather_impact_level(weather_data: Dict[str, Any]) -> Dict[str, Any]:
     impact_score = 0
     factors = []
     
-    # Temperature impact
-    temp = weather_data.get("temperature_c", 10)
-    if temp < 0:
-        impact_score += 2
-        factors.append("Freezing temperatures")
-    elif temp < 5:
-        impact_score += 1
-        factors.append("Cold weather")
-    elif temp > 30:
-        impact_score += 1
-        factors.append("Heat")
-    
-    # Precipitation impact
-    precip = weather_data.get("precipitation_mm", 0)
-    if precip > 5:
-        impact_score += 3
-        factors.append("Heavy precipitation")
-    elif precip > 1:
-        impact_score += 2
-        factors.append("Moderate precipitation")
-    elif precip > 0:
-        impact_score += 1
-        factors.append("Light precipitation")
-    
-    # Wind impact
-    wind = weather_data.get("wind_speed_kmh", 0)
-    if wind > 50:
-        impact_score += 3
-        factors.append("Strong winds")
-    elif wind > 30:
-        impact_score += 2
-        factors.append("Moderate winds")
-    elif wind > 20:
-        impact_score += 1
-        factors.append("Light winds")
-    
-    # Weather code impact
-    code = weather_data.get("weather_code", 0)
-    if code >= 95:  # Thunderstorm
-        impact_score += 3
-        factors.append("Thunderstorm")
-    elif code >= 71:  # Snow
-        impact_score += 2
-        factors.append("Snow")
-    elif code >= 61:  # Rain
-        impact_score += 1
-    elif code >= 45:  # Fog
-        impact_score += 1
-        factors.append("Reduced visibility")
+    for field, default, passes, table in IMPACT_RULES:
+        value = weather_data.get(field, default)
+        for threshold, points, factor in table:
+            if passes(value, threshold):
+                impact_score += points
+                if factor:
+                    factors.append(factor)
+                break
     
     # Determine level
-    if impact_score >= 6:
-        level = "high"
-        description = "Significant delays expected"
-    elif impact_score >= 3:
-        level = "medium"
-        description = "Some delays possible"
-    else:
-        level = "low"
-        description = "Normal operations expected"
+    level, description = next(
+        (level, description)
+        for min_score, level, description in IMPACT_LEVELS
+        if impact_score >= min_score
+    )
     
     return {
         "level": level,
         "score": impact_score,
         "description": description,
         "factors": factors,
-        "weather_description": get_weather_description(code)
+        "weather_description": get_weather_description(weather_data.get("weather_code", 0))
     }
 
@@ -1,9 +1,11 @@
 import os
-import requests
+import asyncio
+import httpx
 import hmac
 import hashlib
 import base64
 import json
+import orjson
 import time
 import uuid
 from datetime import datetime
@@ -14,6 +16,8 @@ load_dotenv()
 GTI_USER = os.getenv("GTI_USER")
 GTI_PASSWORD = os.getenv("GTI_PASSWORD")
 API_URL = "https://gti.geofox.de/gti/public/getVehicleMap"
+# HMAC-Schlüssel nur einmal kodieren statt bei jedem Request
+_GTI_KEY = (GTI_PASSWORD or "").encode("utf-8")
 
 # Hamburg in 4 Kacheln
 HAMBURG_AREA = {
@@ -34,17 +38,36 @@ VEHICLE_TYPES = [
     "XPRESSBUS",
     "U_BAHN"
 ]
+# Mindestabstand zwischen zwei Requests (die API erlaubt max. 1 Request/Sekunde)
+REQUEST_INTERVAL = 1.2
 # hier können wir nochmal checken, ob wir auch alle Linien ohne ins limit zu rutschen ziehen können
 TARGET_LINES = ["6", "7", "U3"]
 
 
-def get_signature(body_payload, password):
-    key = bytes(password, 'utf-8')
-    message = bytes(json.dumps(body_payload, separators=(',', ':')), 'utf-8')
-    hashed = hmac.new(key, message, hashlib.sha1)
+def get_signature(payload_bytes, key=_GTI_KEY):
+    # Signiert genau die Bytes, die auch gesendet werden
+    hashed = hmac.new(key, payload_bytes, hashlib.sha1)
     return base64.b64encode(hashed.digest()).decode('utf-8')
 
 
+class RateLimiter:
+    """Verteilt Request-Starts im Abstand von mindestens `interval` Sekunden."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next_slot = 0.0
+
+    async def wait(self):
+        # Slot ohne await dazwischen reservieren, dann bis zum Slot schlafen
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        await asyncio.sleep(slot - now)
+
+
+_rate_limiter = RateLimiter(REQUEST_INTERVAL)
+
+
 def generate_grid_boxes(area, rows, cols):
     boxes = []
     lat_step = (area["lat_max"] - area["lat_min"]) / rows
@@ -65,7 +88,7 @@ def generate_grid_boxes(area, rows, cols):
     return boxes
 
 
-def fetch_data_for_box(bbox):
+async def fetch_data_for_box(client, bbox):
     now_ts = int(time.time())
 
     payload = {
@@ -78,25 +101,24 @@ def fetch_data_for_box(bbox):
         "withoutCoords": True
     }
 
-    payload_json_str = json.dumps(payload, separators=(',', ':'))
-    payload_bytes = payload_json_str.encode('utf-8')
+    payload_bytes = json.dumps(payload, separators=(',', ':')).encode('utf-8')
 
     headers = {
         "Content-Type": "application/json;charset=UTF-8",
         "Accept": "application/json",
         "geofox-auth-user": GTI_USER,
-        "geofox-auth-signature": get_signature(payload, GTI_PASSWORD),
+        "geofox-auth-signature": get_signature(payload_bytes),
         "geofox-auth-type": "HmacSHA1",
         "X-TraceId": str(uuid.uuid4()),
         "X-Platform": "web"
     }
 
+    await _rate_limiter.wait()
     try:
-        response = requests.post(
+        response = await client.post(
             API_URL,
-            data=payload_bytes,
-            headers=headers,
-            timeout=15
+            content=payload_bytes,
+            headers=headers
         )
 
         if response.status_code == 200:
@@ -123,16 +145,16 @@ def save_filtered_data(data, filename, box_index):
 
     if relevant_journeys:
         record = {
-            "ingestion_iso": datetime.now().isoformat(),
+            "ingestion_iso": datetime.now(),  # orjson schreibt ISO-8601
             "box_index": box_index,  # beschreibt die genutzte Kachel
             "journeys": relevant_journeys
         }
-        with open(filename, "a", encoding="utf-8") as f:
-            f.write(json.dumps(record) + "\n")
+        with open(filename, "ab") as f:
+            f.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
         print(f"   -> {len(relevant_journeys)} Treffer in Box {box_index} gespeichert.")
 
 
-if __name__ == "__main__":
+async def main():
     print(f"Initialisiere Kacheln ({GRID_ROWS}x{GRID_COLS}) für Linien {TARGET_LINES}...")
 
     # 1. Kacheln
@@ -141,29 +163,32 @@ if __name__ == "__main__":
 
     filename = f"geofox_grid_{datetime.now().strftime('%Y-%m-%d')}.jsonl"
 
-    try:
+    # Ein Client für alle Requests: die Verbindung zu gti.geofox.de bleibt offen
+    # und jeder Request spart sich den TLS-Handshake
+    async with httpx.AsyncClient(timeout=15.0) as client:
         while True:
             cycle_start = time.time()
             print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Starte neuen Zyklus...")
 
-            # 2. Alle Kacheln durchgehen
-            for i, bbox in enumerate(grid_boxes):
-                data = fetch_data_for_box(bbox)
+            # 2. Alle Kacheln gleichzeitig abfragen; der RateLimiter hält
+            # >1 Sekunde zwischen den Request-Starts ein (3. Rate Limiting)
+            results = await asyncio.gather(*(fetch_data_for_box(client, bbox) for bbox in grid_boxes))
 
+            for i, data in enumerate(results):
                 if data and data.get("returnCode") == "OK":
                     save_filtered_data(data, filename, i + 1)
                 elif data:
                     print(f"   [!] API Error: {data.get('errorText')}")
 
-                # 3. Rate Limiting
-                # Wir müssen >1 Sekunde warten zwischen den Boxen
-                time.sleep(2.0)
-
             duration = time.time() - cycle_start
             wait_time = max(0, 30 - duration)  # Versuche einen 30-Sekunden-Takt zu halten
 
             print(f"Zyklus beendet in {duration:.2f}s. Warte {wait_time:.2f}s...")
-            time.sleep(wait_time)
+            await asyncio.sleep(wait_time)
 
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
     except KeyboardInterrupt:
-        print("\nIngestion beendet.")
\ No newline at end of file
+        print("\nIngestion beendet.")
@@ -7,20 +7,41 @@ Open-Meteo is free, no API key required.
 - Historical: https://archive-api.open-meteo.com/v1/archive
 """
 
+import asyncio
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import logging
+import orjson
 import time
-from datetime import datetime, timedelta
+from itertools import islice, zip_longest
+from datetime import date, datetime, timedelta
 from pathlib import Path
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
 
 # Hamburg coordinates
 HAMBURG_LAT = 53.55
 HAMBURG_LON = 9.99
+LOCATION = {"lat": HAMBURG_LAT, "lon": HAMBURG_LON, "city": "Hamburg"}
+
+# Open-Meteo returns local wall-clock times for this zone (see "timezone" params)
+LOCAL_TZ = ZoneInfo("Europe/Berlin")
 
 # API endpoints
 FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
 HISTORICAL_URL = "https://archive-api.open-meteo.com/v1/archive"
 
+# Keep-alive session, so periodic collection reuses one TLS connection
+# per Open-Meteo host instead of a new handshake per request
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=2))
+
+# Days fetched in parallel during a backfill
+BACKFILL_CONCURRENCY = 6
+
 # Weather variables to collect
 WEATHER_VARIABLES = [
     "temperature_2m",
@@ -32,38 +53,89 @@ WEATHER_VARIABLES = [
 ]
 
 
+def local_time_to_unix(time_str: str) -> int:
+    """Unix timestamp of an Open-Meteo local time string like '2025-11-20T14:00'."""
+    return int(datetime.fromisoformat(time_str).replace(tzinfo=LOCAL_TZ).timestamp())
+
+
+def hour_bucket(timestamp_unix):
+    """Start of the hour containing timestamp_unix (the pipeline's weather join key)."""
+    return timestamp_unix - timestamp_unix % 3600
+
+
 def fetch_current_weather():
     """Fetch current weather conditions for Hamburg."""
     params = {
         "latitude": HAMBURG_LAT,
         "longitude": HAMBURG_LON,
         "current": ",".join(WEATHER_VARIABLES),
-        "timezone": "Europe/Berlin"
+        "timezone": LOCAL_TZ.key
     }
     
     try:
-        response = requests.get(FORECAST_URL, params=params, timeout=10)
+        response = _session.get(FORECAST_URL, params=params, timeout=10)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
         current = data.get("current", {})
+        timestamp_unix = local_time_to_unix(current.get("time")) if current.get("time") else None
         
         return {
             "timestamp_iso": current.get("time"),
-            "timestamp_unix": int(datetime.fromisoformat(current.get("time")).timestamp()) if current.get("time") else None,
+            "timestamp_unix": timestamp_unix,
+            "weather_join_ts": hour_bucket(timestamp_unix) if timestamp_unix is not None else None,
             "temperature_c": current.get("temperature_2m"),
             "precipitation_mm": current.get("precipitation"),
             "wind_speed_kmh": current.get("wind_speed_10m"),
             "weather_code": current.get("weather_code"),
             "humidity_percent": current.get("relative_humidity_2m"),
             "cloud_cover_percent": current.get("cloud_cover"),
-            "location": {"lat": HAMBURG_LAT, "lon": HAMBURG_LON, "city": "Hamburg"}
+            "location": LOCATION
         }
     except Exception as e:
         print(f"[!] Error fetching current weather: {e}")
         return None
 
 
+def historical_params(date_str: str) -> dict:
+    """Archive API query parameters for one day of hourly data."""
+    return {
+        "latitude": HAMBURG_LAT,
+        "longitude": HAMBURG_LON,
+        "start_date": date_str,
+        "end_date": date_str,
+        "hourly": ",".join(WEATHER_VARIABLES),
+        "timezone": LOCAL_TZ.key
+    }
+
+
+def parse_historical_weather(data: dict):
+    """Turn an archive API response into hourly weather records."""
+    hourly = data.get("hourly", {})
+    times = hourly.get("time", [])
+    
+    # One row per timestamp; shorter variable columns are padded with None
+    columns = [hourly.get(variable) or [] for variable in WEATHER_VARIABLES]
+    unix_times = [local_time_to_unix(time_str) for time_str in times]
+    rows = islice(zip_longest(times, unix_times, *columns), len(times))
+    
+    return [
+        {
+            "timestamp_iso": time_str,
+            "timestamp_unix": timestamp_unix,
+            "weather_join_ts": hour_bucket(timestamp_unix),
+            "temperature_c": temperature,
+            "precipitation_mm": precipitation,
+            "wind_speed_kmh": wind_speed,
+            "weather_code": weather_code,
+            "humidity_percent": humidity,
+            "cloud_cover_percent": cloud_cover,
+            "location": LOCATION
+        }
+        for time_str, timestamp_unix, temperature, precipitation, wind_speed, weather_code, humidity, cloud_cover in rows
+    ]
+
+
 def fetch_historical_weather(date_str: str):
     """
     Fetch historical weather data for a specific date.
@@ -74,48 +146,40 @@ def fetch_historical_weather(date_str: str):
     Returns:
         List of hourly weather records for that day
     """
-    params = {
-        "latitude": HAMBURG_LAT,
-        "longitude": HAMBURG_LON,
-        "start_date": date_str,
-        "end_date": date_str,
-        "hourly": ",".join(WEATHER_VARIABLES),
-        "timezone": "Europe/Berlin"
-    }
-    
     try:
-        response = requests.get(HISTORICAL_URL, params=params, timeout=15)
+        response = _session.get(HISTORICAL_URL, params=historical_params(date_str), timeout=15)
         response.raise_for_status()
-        data = response.json()
-        
-        hourly = data.get("hourly", {})
-        times = hourly.get("time", [])
-        
-        records = []
-        for i, time_str in enumerate(times):
-            record = {
-                "timestamp_iso": time_str,
-                "timestamp_unix": int(datetime.fromisoformat(time_str).timestamp()),
-                "temperature_c": hourly.get("temperature_2m", [None])[i] if i < len(hourly.get("temperature_2m", [])) else None,
-                "precipitation_mm": hourly.get("precipitation", [None])[i] if i < len(hourly.get("precipitation", [])) else None,
-                "wind_speed_kmh": hourly.get("wind_speed_10m", [None])[i] if i < len(hourly.get("wind_speed_10m", [])) else None,
-                "weather_code": hourly.get("weather_code", [None])[i] if i < len(hourly.get("weather_code", [])) else None,
-                "humidity_percent": hourly.get("relative_humidity_2m", [None])[i] if i < len(hourly.get("relative_humidity_2m", [])) else None,
-                "cloud_cover_percent": hourly.get("cloud_cover", [None])[i] if i < len(hourly.get("cloud_cover", [])) else None,
-                "location": {"lat": HAMBURG_LAT, "lon": HAMBURG_LON, "city": "Hamburg"}
-            }
-            records.append(record)
-        
-        return records
+        return parse_historical_weather(orjson.loads(response.content))
     except Exception as e:
         print(f"[!] Error fetching historical weather for {date_str}: {e}")
         return []
 
 
-def save_weather_record(record: dict, filename: str):
-    """Append a weather record to JSONL file."""
-    with open(filename, "a", encoding="utf-8") as f:
-        f.write(json.dumps(record) + "\n")
+async def fetch_historical_weather_async(client: httpx.AsyncClient, date_str: str, semaphore: asyncio.Semaphore):
+    """Async variant of fetch_historical_weather; at most `semaphore` days run at once."""
+    async with semaphore:
+        try:
+            response = await client.get(HISTORICAL_URL, params=historical_params(date_str))
+            response.raise_for_status()
+            return parse_historical_weather(orjson.loads(response.content))
+        except Exception as e:
+            print(f"[!] Error fetching historical weather for {date_str}: {e}")
+            return []
+
+
+async def fetch_historical_range(date_strs):
+    """Fetch several days concurrently over one client; results in input order."""
+    semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+    limits = httpx.Limits(max_connections=BACKFILL_CONCURRENCY)
+    async with httpx.AsyncClient(timeout=15.0, limits=limits) as client:
+        return await asyncio.gather(
+            *(fetch_historical_weather_async(client, date_str, semaphore) for date_str in date_strs)
+        )
+
+
+def write_weather_record(record: dict, f):
+    """Append a weather record to an open binary JSONL file."""
+    f.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
 
 
 def backfill_weather(start_date: str, end_date: str = None):
@@ -128,26 +192,24 @@ def backfill_weather(start_date: str, end_date: str = None):
         end_date: End date 'YYYY-MM-DD' (default: today)
     """
     if end_date is None:
-        end_date = datetime.now().strftime("%Y-%m-%d")
+        end_date = date.today().isoformat()
+    
+    start = date.fromisoformat(start_date)
+    end = date.fromisoformat(end_date)
+    
+    date_strs = [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+    print(f"Fetching weather for {len(date_strs)} days ({BACKFILL_CONCURRENCY} at a time)...")
     
-    start = datetime.strptime(start_date, "%Y-%m-%d")
-    end = datetime.strptime(end_date, "%Y-%m-%d")
+    # Requests overlap; BACKFILL_CONCURRENCY keeps the load on the API bounded
+    all_records = asyncio.run(fetch_historical_range(date_strs))
     
-    current = start
-    while current <= end:
-        date_str = current.strftime("%Y-%m-%d")
+    for date_str, records in zip(date_strs, all_records):
         filename = f"weather_{date_str}.jsonl"
-        
-        print(f"Fetching weather for {date_str}...")
-        records = fetch_historical_weather(date_str)
-        
-        for record in records:
-            save_weather_record(record, filename)
+        with open(filename, "ab", buffering=1 << 20) as f:
+            for record in records:
+                write_weather_record(record, f)
         
         print(f"  -> Saved {len(records)} hourly records to {filename}")
-        
-        current += timedelta(days=1)
-        time.sleep(0.5)  # Be nice to the API
 
 
 def run_continuous_collection(interval_seconds: int = 300):
@@ -162,34 +224,46 @@ def run_continuous_collection(interval_seconds: int = 300):
     print(f"Interval: {interval_seconds} seconds")
     print("Press Ctrl+C to stop\n")
     
+    # The day's file stays open; each record is flushed so readers see it
+    f = open(filename, "ab")
     try:
         while True:
+            cycle_start = time.monotonic()
+            
             # Check if we need a new file (new day)
             current_date = datetime.now().strftime('%Y-%m-%d')
             expected_filename = f"weather_{current_date}.jsonl"
             if filename != expected_filename:
+                f.close()
                 filename = expected_filename
+                f = open(filename, "ab")
                 print(f"\n[New day] Switching to {filename}")
             
             # Fetch and save
             record = fetch_current_weather()
             if record:
-                save_weather_record(record, filename)
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] "
-                      f"Temp: {record['temperature_c']}°C, "
-                      f"Rain: {record['precipitation_mm']}mm, "
-                      f"Wind: {record['wind_speed_kmh']}km/h, "
-                      f"Code: {record['weather_code']}")
+                write_weather_record(record, f)
+                f.flush()
+                logger.info(
+                    "Temp: %s°C, Rain: %smm, Wind: %skm/h, Code: %s",
+                    record["temperature_c"], record["precipitation_mm"],
+                    record["wind_speed_kmh"], record["weather_code"]
+                )
             
-            time.sleep(interval_seconds)
+            # Keep the cadence steady regardless of fetch time or clock changes
+            time.sleep(max(0.0, interval_seconds - (time.monotonic() - cycle_start)))
             
     except KeyboardInterrupt:
         print("\n\nWeather collection stopped.")
+    finally:
+        f.close()
 
 
 if __name__ == "__main__":
     import sys
     
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s", datefmt="%H:%M:%S")
+    
     if len(sys.argv) > 1:
         if sys.argv[1] == "backfill":
             # Usage: python weather_producer.py backfill 2025-11-20 2025-11-25
@@ -3,16 +3,32 @@ PySpark pipeline for processing transport and weather data.
 Flattens nested JSONL, joins datasets, and prepares features for ML.
 """
 
-from pyspark.sql import SparkSession
+from pyspark.sql import DataFrame, SparkSession
 from pyspark.sql.functions import (
-    explode, col, from_unixtime, hour, dayofweek, 
-    when, floor, lit, concat_ws
+    explode, col, timestamp_seconds, hour, dayofweek, 
+    when, lit, concat_ws, broadcast, coalesce
 )
 from pyspark.sql.types import (
     StructType, StructField, StringType, IntegerType, 
     LongType, DoubleType, BooleanType, ArrayType
 )
 from pathlib import Path
+from datetime import date, timedelta
+from typing import Callable, List, Optional, Tuple, Union
+import glob
+import hashlib
+import logging
+import shutil
+
+logger = logging.getLogger(__name__)
+
+# 7-9 and 16-19 o'clock; Spark dayofweek: 1=Sunday, 7=Saturday
+RUSH_HOURS = [7, 8, 9, 16, 17, 18, 19]
+WEEKEND_DAYS = [1, 7]
+
+# Flattened Parquet snapshots of the transport JSONL files, shared with
+# the API's history manager
+PARQUET_CACHE_DIR = Path(__file__).parent.parent / "api" / "cache"
 
 
 def create_spark_session(app_name: str = "DelayPredictor") -> SparkSession:
@@ -20,6 +36,10 @@ def create_spark_session(app_name: str = "DelayPredictor") -> SparkSession:
     return SparkSession.builder \
         .appName(app_name) \
         .config("spark.sql.legacy.timeParserPolicy", "LEGACY") \
+        .config("spark.sql.autoBroadcastJoinThreshold", "32m") \
+        .config("spark.sql.execution.arrow.pyspark.enabled", "true") \
+        .config("spark.sql.execution.arrow.pyspark.fallback.enabled", "true") \
+        .config("spark.sql.execution.arrow.maxRecordsPerBatch", "50000") \
         .getOrCreate()
 
 
@@ -79,6 +99,7 @@ def get_weather_schema():
     return StructType([
         StructField("timestamp_iso", StringType(), True),
         StructField("timestamp_unix", LongType(), True),
+        StructField("weather_join_ts", LongType(), True),
         StructField("temperature_c", DoubleType(), True),
         StructField("precipitation_mm", DoubleType(), True),
         StructField("wind_speed_kmh", DoubleType(), True),
@@ -140,6 +161,85 @@ def load_transport_data(spark: SparkSession, path: str):
     return flattened
 
 
+def files_for_date_range(pattern: str, date_range: Tuple[str, str]) -> List[str]:
+    """
+    Existing files of a daily pattern like "geofox_grid_*.jsonl" whose "*"
+    is a date within date_range ('YYYY-MM-DD', inclusive), so only those
+    days are listed and read instead of every file matching the glob.
+    """
+    start, end = (date.fromisoformat(d) for d in date_range)
+    days = (start + timedelta(days=i) for i in range((end - start).days + 1))
+    candidates = (pattern.replace("*", day.isoformat(), 1) for day in days)
+    return [path for path in candidates if Path(path).exists()]
+
+
+def snapshot_path(jsonl_path: Path, cache_dir: Path, prefix: str) -> Path:
+    """Parquet snapshot location for one JSONL file in its current state."""
+    stat = jsonl_path.stat()
+    digest = hashlib.sha1(
+        f"{jsonl_path.name}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8")
+    ).hexdigest()[:16]
+    return cache_dir / f"{prefix}_{jsonl_path.stem}_{digest}.parquet"
+
+
+def sync_parquet_snapshots(jsonl_files: List[Path], cache_dir: Path, prefix: str,
+                           flatten: Callable[[str], DataFrame],
+                           prune_unlisted: bool = False) -> List[str]:
+    """
+    Make sure every JSONL file has an up-to-date Parquet snapshot.
+    
+    flatten(path) returns the flattened DataFrame of one JSONL file; it is
+    only called for files that changed since their last snapshot (usually
+    just today's, which the collector is appending to), so finished days
+    are read straight from Parquet. Outdated snapshots of the listed files
+    are removed; with prune_unlisted, every other snapshot with this
+    prefix (e.g. of a deleted file) is removed as well. The prefix keeps
+    differently flattened tables apart in a shared cache_dir.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    snapshots = []
+    for jsonl_path in jsonl_files:
+        snapshot = snapshot_path(jsonl_path, cache_dir, prefix)
+        if not (snapshot / "_SUCCESS").exists():
+            flatten(str(jsonl_path)).write.mode("overwrite").parquet(str(snapshot))
+            logger.info("Saved Parquet snapshot: %s", snapshot)
+        snapshots.append(snapshot)
+    
+    if prune_unlisted:
+        stale = cache_dir.glob(f"{prefix}_*.parquet")
+    else:
+        stale = (path for jsonl_path in jsonl_files
+                 for path in cache_dir.glob(f"{prefix}_{jsonl_path.stem}_*.parquet"))
+    for path in stale:
+        if path not in snapshots:
+            shutil.rmtree(path, ignore_errors=True)
+    
+    return [str(path) for path in snapshots]
+
+
+def load_transport_data_cached(spark: SparkSession, path: Union[str, List[str]],
+                               cache_dir: Path = PARQUET_CACHE_DIR):
+    """
+    Load flattened transport data through per-file Parquet snapshots.
+    
+    Each JSONL file is parsed and flattened once; later runs read its
+    snapshot, where Spark only decodes the columns the pipeline uses.
+    Snapshots are written as "transport_*" next to the API's own in
+    cache_dir (app/api/cache by default). path is a glob or a list of
+    files.
+    """
+    patterns = [path] if isinstance(path, str) else path
+    jsonl_files = [Path(p) for pattern in patterns for p in sorted(glob.glob(pattern))]
+    if not jsonl_files:
+        return load_transport_data(spark, path)
+    
+    snapshots = sync_parquet_snapshots(
+        jsonl_files, cache_dir, "transport",
+        lambda jsonl_path: load_transport_data(spark, jsonl_path)
+    )
+    return spark.read.parquet(*snapshots)
+
+
 def load_weather_data(spark: SparkSession, path: str):
     """Load weather JSONL data."""
     schema = get_weather_schema()
@@ -151,16 +251,17 @@ def join_transport_weather(transport_df, weather_df):
     Join transport and weather data on timestamp.
     Weather is joined by rounding transport timestamp to nearest hour.
     """
-    # Round transport timestamp to nearest hour for joining
+    # Round transport timestamp down to the hour for joining
     transport_with_hour = transport_df.withColumn(
         "weather_join_ts",
-        (floor(col("start_timestamp") / 3600) * 3600).cast("long")
+        col("start_timestamp") - col("start_timestamp") % 3600
     )
     
-    # Round weather timestamp to hour
+    # The producer stores the weather hour; records written before it did
+    # are rounded here
     weather_hourly = weather_df.withColumn(
         "weather_join_ts", 
-        (floor(col("timestamp_unix") / 3600) * 3600).cast("long")
+        coalesce(col("weather_join_ts"), col("timestamp_unix") - col("timestamp_unix") % 3600)
     ).select(
         col("weather_join_ts"),
         col("temperature_c"),
@@ -171,9 +272,10 @@ def join_transport_weather(transport_df, weather_df):
         col("cloud_cover_percent")
     ).dropDuplicates(["weather_join_ts"])
     
-    # Join
+    # Join; weather is one row per hour, so ship it to every executor
+    # instead of shuffling the much larger segment table
     joined = transport_with_hour.join(
-        weather_hourly,
+        broadcast(weather_hourly),
         on="weather_join_ts",
         how="left"
     )
@@ -183,37 +285,40 @@ def join_transport_weather(transport_df, weather_df):
 
 def add_time_features(df):
     """Add time-based features for ML."""
+    # Convert the timestamp once; hour and weekday are read from that column
     return df \
-        .withColumn("datetime", from_unixtime(col("start_timestamp"))) \
-        .withColumn("hour_of_day", hour(from_unixtime(col("start_timestamp")))) \
-        .withColumn("day_of_week", dayofweek(from_unixtime(col("start_timestamp")))) \
-        .withColumn(
-            "is_rush_hour",
-            when(
-                (col("hour_of_day").between(7, 9)) | 
-                (col("hour_of_day").between(16, 19)),
-                1
-            ).otherwise(0)
-        ) \
-        .withColumn(
-            "is_weekend",
-            when(col("day_of_week").isin([1, 7]), 1).otherwise(0)
-        )
+        .withColumn("datetime", timestamp_seconds(col("start_timestamp"))) \
+        .withColumns({
+            "hour_of_day": hour(col("datetime")),
+            "day_of_week": dayofweek(col("datetime"))
+        }) \
+        .withColumns({
+            "is_rush_hour": when(col("hour_of_day").isin(RUSH_HOURS), 1).otherwise(0),
+            "is_weekend": when(col("day_of_week").isin(WEEKEND_DAYS), 1).otherwise(0)
+        })
 
 
-def create_ml_dataset(spark: SparkSession, transport_path: str, weather_path: str):
+def create_ml_dataset(spark: SparkSession, transport_path: str, weather_path: str,
+                      date_range: Optional[Tuple[str, str]] = None):
     """
     Full pipeline: load, flatten, join, and prepare ML dataset.
     
+    With date_range ('YYYY-MM-DD', 'YYYY-MM-DD'), only the daily files
+    of those dates are read from the transport and weather patterns.
+    
     Returns DataFrame ready for ML with all features.
     """
+    if date_range is not None:
+        transport_path = files_for_date_range(transport_path, date_range)
+        weather_path = files_for_date_range(weather_path, date_range)
+        print(f"Using {len(transport_path)} transport and {len(weather_path)} weather files "
+              f"from {date_range[0]} to {date_range[1]}")
+    
     print("Loading transport data...")
-    transport_df = load_transport_data(spark, transport_path)
-    print(f"  -> {transport_df.count()} segment records")
+    transport_df = load_transport_data_cached(spark, transport_path)
     
     print("Loading weather data...")
     weather_df = load_weather_data(spark, weather_path)
-    print(f"  -> {weather_df.count()} weather records")
     
     print("Joining datasets...")
     joined_df = join_transport_weather(transport_df, weather_df)
@@ -278,6 +383,10 @@ if __name__ == "__main__":
         weather_path = sys.argv[2]
     if len(sys.argv) > 3:
         output_path = sys.argv[3]
+    # Optional date range: start [end], defaulting to today
+    date_range = None
+    if len(sys.argv) > 4:
+        date_range = (sys.argv[4], sys.argv[5] if len(sys.argv) > 5 else date.today().isoformat())
     
     print("=" * 60)
     print("Delay Prediction - Data Pipeline")
@@ -292,7 +401,7 @@ if __name__ == "__main__":
     
     try:
         # Run pipeline
-        ml_df = create_ml_dataset(spark, transport_path, weather_path)
+        ml_df = create_ml_dataset(spark, transport_path, weather_path, date_range)
         
         # Show sample
         print("\nSample data:")
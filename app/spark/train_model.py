@@ -5,14 +5,16 @@ Uses PySpark for data loading and preprocessing, then trains with scikit-learn.
 This hybrid approach works well for prototype/medium datasets.
 """
 
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import col, when
 from pyspark.ml.feature import StringIndexer, VectorAssembler
-from pyspark.ml import Pipeline
 
 import pandas as pd
 import numpy as np
-from sklearn.ensemble import RandomForestRegressor, RandomForestClassifier
+import pyarrow as pa
+from sklearn.ensemble import HistGradientBoostingRegressor, HistGradientBoostingClassifier
+from sklearn.inspection import permutation_importance
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import (
     mean_absolute_error, mean_squared_error, r2_score,
@@ -20,6 +22,7 @@ from sklearn.metrics import (
     classification_report
 )
 import joblib
+from joblib import Parallel, delayed
 from pathlib import Path
 from datetime import datetime
 
@@ -29,65 +32,93 @@ from delay_pipeline import create_spark_session, create_ml_dataset
 def prepare_features_spark(df):
     """
     Use Spark ML to encode categorical features.
-    Returns DataFrame with encoded features.
+    Returns DataFrame with encoded features, the indexed column names and
+    each categorical column's fitted labels (the label's position is its
+    index), so the predictor can encode inputs exactly like training did.
     """
-    # String indexers for categorical columns
     categorical_cols = ["line", "vehicle_type", "line_type", "direction"]
-    indexers = []
-    indexed_cols = []
-    
-    for col_name in categorical_cols:
-        # Check if column has non-null values
-        indexer = StringIndexer(
-            inputCol=col_name, 
-            outputCol=f"{col_name}_idx",
-            handleInvalid="keep"
-        )
-        indexers.append(indexer)
-        indexed_cols.append(f"{col_name}_idx")
+    indexed_cols = [f"{col_name}_idx" for col_name in categorical_cols]
     
-    # Build pipeline
-    pipeline = Pipeline(stages=indexers)
+    # One multi-column indexer counts all four columns' values in a single
+    # pass over the data, instead of one fit job per column
+    indexer = StringIndexer(
+        inputCols=categorical_cols,
+        outputCols=indexed_cols,
+        handleInvalid="keep"
+    )
     
     # Fit and transform
-    model = pipeline.fit(df)
+    model = indexer.fit(df)
     encoded_df = model.transform(df)
+    category_labels = {
+        col_name: list(labels)
+        for col_name, labels in zip(categorical_cols, model.labelsArray)
+    }
     
-    return encoded_df, indexed_cols
+    return encoded_df, indexed_cols, category_labels
 
 
-def spark_to_pandas_ml(spark_df, feature_cols, target_col):
+def spark_to_numpy_ml(spark_df, feature_cols, target_col):
     """
-    Convert Spark DataFrame to pandas for sklearn training.
+    Collect a Spark DataFrame as NumPy arrays for sklearn training.
     Handles null values and prepares X, y arrays.
+    
+    Rows arrive as Arrow batches and the arrays are built straight from
+    the Arrow columns, without an intermediate pandas DataFrame.
     """
-    # Select only needed columns and drop nulls
-    ml_df = spark_df.select(*feature_cols, target_col).dropna()
+    # Select only needed columns and drop nulls. Features are cast to
+    # float32, the dtype the API predicts with, so X is built at half the
+    # size of float64 and every Arrow column converts without Python objects
+    ml_df = spark_df.select(
+        *[col(c).cast("float") for c in feature_cols], target_col
+    ).dropna()
     
-    # Convert to pandas
-    pdf = ml_df.toPandas()
+    # DataFrame.toArrow is Spark 4.0+; 3.5 has the same collect as a private method
+    if hasattr(ml_df, "toArrow"):
+        table = ml_df.toArrow()
+    else:
+        table = pa.Table.from_batches(ml_df._collect_as_arrow())
     
-    X = pdf[feature_cols].values
-    y = pdf[target_col].values
+    X = np.empty((table.num_rows, len(feature_cols)), dtype=np.float32)
+    for i, c in enumerate(feature_cols):
+        X[:, i] = table.column(c).to_numpy()
+    y = table.column(target_col).to_numpy()
     
-    return X, y, pdf
+    return X, y
+
+
+# Histogram bins per feature; also the largest category count a feature
+# can have to be split natively as categorical
+MAX_BINS = 255
+
 
+def categorical_feature_indices(feature_cols, category_labels):
+    """
+    Positions of the indexed columns that histogram boosting can treat as
+    categorical: their labels plus the StringIndexer's "unknown" index
+    must fit into MAX_BINS categories.
+    """
+    return [
+        i for i, col_name in enumerate(feature_cols)
+        if col_name.endswith("_idx")
+        and len(category_labels.get(col_name[:-len("_idx")], [])) + 1 <= MAX_BINS
+    ]
 
-def train_regression_model(X_train, y_train, X_test, y_test):
+
+def train_regression_model(X_train, y_train, X_test, y_test, categorical_features=None):
     """
-    Train a RandomForestRegressor to predict delay in minutes.
+    Train a HistGradientBoostingRegressor to predict delay in minutes.
     """
     print("\n" + "="*50)
     print("Training REGRESSION model (predicting delay minutes)")
     print("="*50)
     
-    model = RandomForestRegressor(
-        n_estimators=100,
-        max_depth=15,
-        min_samples_split=5,
-        min_samples_leaf=2,
-        random_state=42,
-        n_jobs=-1
+    model = HistGradientBoostingRegressor(
+        max_iter=300,
+        max_bins=MAX_BINS,
+        early_stopping=True,
+        categorical_features=categorical_features,
+        random_state=42
     )
     
     model.fit(X_train, y_train)
@@ -108,9 +139,10 @@ def train_regression_model(X_train, y_train, X_test, y_test):
     return model, {"mae": mae, "rmse": rmse, "r2": r2}
 
 
-def train_classification_model(X_train, y_train, X_test, y_test, delay_threshold=2):
+def train_classification_model(X_train, y_train, X_test, y_test, delay_threshold=2,
+                               categorical_features=None):
     """
-    Train a RandomForestClassifier to predict if delayed (delay > threshold).
+    Train a HistGradientBoostingClassifier to predict if delayed (delay > threshold).
     """
     print("\n" + "="*50)
     print(f"Training CLASSIFICATION model (delay > {delay_threshold} min)")
@@ -124,13 +156,12 @@ def train_classification_model(X_train, y_train, X_test, y_test, delay_threshold
     print(f"  Not delayed: {np.sum(y_train_class == 0)}")
     print(f"  Delayed:     {np.sum(y_train_class == 1)}")
     
-    model = RandomForestClassifier(
-        n_estimators=100,
-        max_depth=15,
-        min_samples_split=5,
-        min_samples_leaf=2,
+    model = HistGradientBoostingClassifier(
+        max_iter=300,
+        max_bins=MAX_BINS,
+        early_stopping=True,
+        categorical_features=categorical_features,
         random_state=42,
-        n_jobs=-1,
         class_weight="balanced"  # Handle imbalanced classes
     )
     
@@ -163,9 +194,18 @@ def train_classification_model(X_train, y_train, X_test, y_test, delay_threshold
     }
 
 
-def get_feature_importance(model, feature_names):
-    """Extract and display feature importances."""
-    importances = model.feature_importances_
+def get_feature_importance(model, feature_names, X_test, y_test):
+    """
+    Extract and display feature importances.
+    
+    Boosted histogram models have no impurity-based importances, so those
+    are measured by permutation on the test set.
+    """
+    importances = getattr(model, "feature_importances_", None)
+    if importances is None:
+        importances = permutation_importance(
+            model, X_test, y_test, n_repeats=5, random_state=42, n_jobs=-1
+        ).importances_mean
     indices = np.argsort(importances)[::-1]
     
     print("\nFeature Importances:")
@@ -175,13 +215,48 @@ def get_feature_importance(model, feature_names):
     return dict(zip(feature_names, importances))
 
 
+def export_onnx(model, onnx_path: str):
+    """
+    Export a fitted model to ONNX for onnxruntime inference in the API.
+    
+    Optional: skipped when skl2onnx is not installed, in which case the API
+    serves the joblib model. A previous export is removed first so the API
+    never pairs a new .pkl with a stale .onnx.
+    """
+    Path(onnx_path).unlink(missing_ok=True)
+    try:
+        from skl2onnx import convert_sklearn
+        from skl2onnx.common.data_types import FloatTensorType
+    except ImportError:
+        print("skl2onnx not installed, skipping ONNX export")
+        return
+    
+    # Classifiers output a plain probability matrix instead of a list of
+    # per-row dicts (zipmap), matching predict_proba
+    options = {id(model): {"zipmap": False}} if hasattr(model, "predict_proba") else None
+    try:
+        onnx_model = convert_sklearn(
+            model,
+            initial_types=[("X", FloatTensorType([None, model.n_features_in_]))],
+            options=options
+        )
+    except Exception as e:
+        # e.g. converters without support for native categorical splits
+        print(f"ONNX export failed ({e}), the API will use the joblib model")
+        return
+    with open(onnx_path, "wb") as f:
+        f.write(onnx_model.SerializeToString())
+    print(f"ONNX model saved to: {onnx_path}")
+
+
 def save_model(model, model_path: str, metadata: dict = None):
-    """Save trained model and metadata."""
+    """Save trained model, its ONNX export and metadata."""
     Path(model_path).parent.mkdir(parents=True, exist_ok=True)
     
     # Save model
     joblib.dump(model, model_path)
     print(f"\nModel saved to: {model_path}")
+    export_onnx(model, model_path.replace(".pkl", ".onnx"))
     
     # Save metadata
     if metadata:
@@ -192,10 +267,12 @@ def save_model(model, model_path: str, metadata: dict = None):
         print(f"Metadata saved to: {metadata_path}")
 
 
-def run_training_pipeline(transport_path: str, weather_path: str, model_output_dir: str):
+def run_training_pipeline(transport_path: str, weather_path: str, model_output_dir: str,
+                          date_range=None):
     """
     Complete training pipeline:
-    1. Load and join data with Spark
+    1. Load and join data with Spark (optionally only the daily files in
+       date_range, see create_ml_dataset)
     2. Prepare features
     3. Train both regression and classification models
     4. Save models
@@ -214,9 +291,13 @@ def run_training_pipeline(transport_path: str, weather_path: str, model_output_d
     try:
         # 1. Create ML dataset
         print("\n[1/5] Creating ML dataset...")
-        ml_df = create_ml_dataset(spark, transport_path, weather_path)
+        # Cached: the count, every StringIndexer fit and the final
+        # conversion all read it, and each would otherwise re-read and
+        # re-flatten the JSONL
+        ml_df = create_ml_dataset(spark, transport_path, weather_path, date_range) \
+            .persist(StorageLevel.MEMORY_AND_DISK)
         
-        # Check data size
+        # Check data size (also materializes the cache)
         count = ml_df.count()
         print(f"Total records: {count}")
         
@@ -226,7 +307,7 @@ def run_training_pipeline(transport_path: str, weather_path: str, model_output_d
         
         # 2. Encode categorical features
         print("\n[2/5] Encoding categorical features...")
-        encoded_df, indexed_cols = prepare_features_spark(ml_df)
+        encoded_df, indexed_cols, category_labels = prepare_features_spark(ml_df)
         
         # 3. Define feature columns
         numeric_features = [
@@ -241,9 +322,10 @@ def run_training_pipeline(transport_path: str, weather_path: str, model_output_d
         print(f"Features: {feature_cols}")
         print(f"Target: {target_col}")
         
-        # 4. Convert to pandas for sklearn
-        print("\n[3/5] Converting to pandas...")
-        X, y, pdf = spark_to_pandas_ml(encoded_df, feature_cols, target_col)
+        # 4. Collect as NumPy arrays for sklearn
+        print("\n[3/5] Collecting features...")
+        X, y = spark_to_numpy_ml(encoded_df, feature_cols, target_col)
+        ml_df.unpersist()  # Free executor memory before sklearn training
         
         print(f"Final dataset shape: X={X.shape}, y={y.shape}")
         print(f"Delay statistics:")
@@ -260,17 +342,27 @@ def run_training_pipeline(transport_path: str, weather_path: str, model_output_d
         # 6. Train models
         print("\n[4/5] Training models...")
         
-        # Regression model
-        reg_model, reg_metrics = train_regression_model(
-            X_train, y_train, X_test, y_test
-        )
-        reg_importance = get_feature_importance(reg_model, feature_cols)
+        # Indexed categoricals are split on natively rather than as ordered numbers
+        categorical_features = categorical_feature_indices(feature_cols, category_labels)
         
-        # Classification model
-        clf_model, clf_metrics = train_classification_model(
-            X_train, y_train, X_test, y_test, delay_threshold=2
+        # Regression and classification models train at the same time in
+        # two worker processes; joblib memory-maps the shared arrays into
+        # both and gives each worker half of the cores for its own threads
+        (reg_model, reg_metrics), (clf_model, clf_metrics) = Parallel(n_jobs=2, backend="loky")([
+            delayed(train_regression_model)(
+                X_train, y_train, X_test, y_test, categorical_features
+            ),
+            delayed(train_classification_model)(
+                X_train, y_train, X_test, y_test, delay_threshold=2,
+                categorical_features=categorical_features
+            )
+        ])
+        
+        reg_importance = get_feature_importance(reg_model, feature_cols, X_test, y_test)
+        clf_importance = get_feature_importance(
+            clf_model, feature_cols, X_test,
+            (y_test > clf_metrics["delay_threshold"]).astype(int)
         )
-        clf_importance = get_feature_importance(clf_model, feature_cols)
         
         # 7. Save models
         print("\n[5/5] Saving models...")
@@ -279,7 +371,7 @@ def run_training_pipeline(transport_path: str, weather_path: str, model_output_d
         
         # Regression model
         reg_metadata = {
-            "model_type": "RandomForestRegressor",
+            "model_type": type(reg_model).__name__,
             "feature_columns": feature_cols,
             "target": target_col,
             "metrics": reg_metrics,
@@ -296,9 +388,10 @@ def run_training_pipeline(transport_path: str, weather_path: str, model_output_d
         
         # Classification model
         clf_metadata = {
-            "model_type": "RandomForestClassifier",
+            "model_type": type(clf_model).__name__,
             "feature_columns": feature_cols,
             "target": f"delay > {clf_metrics['delay_threshold']} min",
+            "classes": clf_model.classes_.tolist(),  # predict_proba column order
             "metrics": clf_metrics,
             "feature_importance": clf_importance,
             "training_date": datetime.now().isoformat(),
@@ -318,7 +411,8 @@ def run_training_pipeline(transport_path: str, weather_path: str, model_output_d
                 "feature_columns": feature_cols,
                 "numeric_features": numeric_features,
                 "categorical_columns": ["line", "vehicle_type", "line_type", "direction"],
-                "indexed_columns": indexed_cols
+                "indexed_columns": indexed_cols,
+                "category_labels": category_labels
             }, f, indent=2)
         
         print("\n" + "="*60)
@@ -349,6 +443,10 @@ if __name__ == "__main__":
         weather_path = sys.argv[2]
     if len(sys.argv) > 3:
         model_output_dir = sys.argv[3]
+    # Optional date range: start [end], defaulting to today
+    date_range = None
+    if len(sys.argv) > 4:
+        date_range = (sys.argv[4], sys.argv[5] if len(sys.argv) > 5 else datetime.now().date().isoformat())
     
-    run_training_pipeline(transport_path, weather_path, model_output_dir)
+    run_training_pipeline(transport_path, weather_path, model_output_dir, date_range)
 